@@ -1,21 +1,25 @@
 from argparse import ArgumentParser
-from pandas import DataFrame, read_excel
+from pandas import DataFrame
+from sys import exit
 from tempfile import NamedTemporaryFile
+from time import perf_counter
 import os
 import stat
 import subprocess
-import requests
+from emg_auth import EmgToken
+from emg_registry import ReferenceIDs
+from emg_submit import case_result, print_results, submit_chunks
+from instrumentation import StageRecorder
+from upload_ledger import default_ledger, submit_once
 
-route_login_platform = 'https://pch-production.emg.illumina.com/api/auth/v2/api_login/'
+# The time and memory of every step are recorded and written with --timings
+recorder = StageRecorder()
+
+# The Emedgene host and user; the login happens in main and reuses a cached token (see emg_auth.py)
+EMG_HOST = 'https://pch-production.emg.illumina.com'
+EMG_ENVIRONMENT = "prod"  # The environment of the cases in the upload ledger
 username = os.environ.get('EMG_USERNAME')
 password = os.environ.get('EMG_PASSWORD')
-payload = {"username": username, "password": password}
-response = requests.post(route_login_platform, json=payload)
-access_token = response.json().get('access_token')
-token_type = response.json().get('token_type')
-#bearer_token = f'{token_type.capitalize()} {access_token}'
-#bearer_token_simplified = access_token
-EMG_AUTH_TOKEN = f'{token_type.capitalize()} {access_token}'
 
 
 def create_parser():
@@ -24,6 +28,26 @@ def create_parser():
                         help="An Illumina V2 sample sheet with the panel bed information in the \"Description\" column of the Cloud Data.")
     parser.add_argument("-r", "--analysis_id", type=str, required=True,
                         help="The ICA root folder for an analysis that produces secondary analysis results")
+    parser.add_argument("--emg_host", type=str, default=EMG_HOST,
+                        help=f"The Emedgene host the cases are created on (default: {EMG_HOST}).")
+    parser.add_argument("--chunk_size", type=int, default=25,
+                        help="The number of cases uploaded together, 0 for a single chunk (default: 25).")
+    parser.add_argument("--parallel_chunks", type=int, default=4,
+                        help="The number of chunks uploaded at the same time (default: 4).")
+    parser.add_argument("--state_file", type=str, default=None,
+                        help="The JSON file the result of every chunk and case is kept in (default: <analysis_id>.emg_upload.state.json in the current folder).")
+    parser.add_argument("--resume", action="store_true",
+                        help="Only upload the cases of the state file that were not created yet, e.g. after a failed upload.")
+    parser.add_argument("--ledger", type=str, default=None,
+                        help="The upload ledger (SQLite, on a local disk) that keeps the cases already sent to Emedgene, so they aren't created twice (default: upload_ledger.sqlite in the local cache, see upload_ledger.py).")
+    parser.add_argument("--no_ledger", action="store_true",
+                        help="Send every case, even when the upload ledger shows it was created before.")
+    parser.add_argument("--no_token_cache", action="store_true",
+                        help="Always log in to Emedgene instead of reusing the cached token of an earlier run.")
+    parser.add_argument("--timings", action="store_true",
+                        help="Write the wall time, CPU time and peak memory of every step to <analysis_id>.emg_upload.timings.json in the current folder.")
+    parser.add_argument("--cprofile", type=str, default=None,
+                        help="Profile the sample sheet parsing and the upload with cProfile and save the profile to this path.")
     return parser
 
 # Function to parse the description and samples of an Illumina V2 sample sheet
@@ -113,7 +137,24 @@ def add_write_permissions_to_all(file_path):
     except OSError as e:
         print(f"Error: Could not change permissions for {file_path}: {e}")
         
-def batch_case_upload(temp_file):
+# The header and columns of the batch CSV of BatchCasesCreator.js
+CSV_HEADER = """[Data],,,,,,,,,,,,,,,,,,,,,,
+Family Id,Case Type,Files Names,Sample Type,BioSample Name,Visualization Files,Storage Provider Id,Default Project,Execute Now,Relation,Sex,Phenotypes,Phenotypes Id,Date Of Birth,Boost Genes,Gene List Id,Kit Id,Intersect Bed Id,Selected Preset,Label Id,Clinical Notes,Due Date,Opt In,
+"""
+CSV_COLUMNS = [
+    "Family Id", "Case Type", "Files Names", "Sample Type", "BioSample Name", "Visualization Files", "Storage Provider Id",
+    "Default Project", "Execute Now", "Relation", "Sex", "Phenotypes", "Phenotypes Id", "Date Of Birth", "Boost Genes",
+    "Gene List Id", "Kit Id", "Intersect Bed Id", "Selected Preset", "Label Id", "Clinical Notes", "Due Date"
+]
+
+def write_batch_csv(temp_file, rows):
+    temp_file.write(CSV_HEADER)
+    for row in rows:
+        for col in CSV_COLUMNS: temp_file.write(row[col]+',')
+        temp_file.write("FALSE\n") #Opt In Value
+    temp_file.flush()  # Ensure data is written to the file
+
+def batch_case_upload(temp_file, host=EMG_HOST, token=None):
     """
     Uploads cases to Emedgene Analyze using the batchCasesCreator CLI.
     
@@ -123,7 +164,7 @@ def batch_case_upload(temp_file):
                and contains the required case data.
     
     Returns:
-    The output of the batchCasesCreator command.
+    Whether the batchCasesCreator command succeeded, and its output.
     """
     add_write_permissions_to_all(temp_file.name)
     
@@ -133,9 +174,9 @@ def batch_case_upload(temp_file):
         "/env/illumina/BatchCasesCreator.js",
         "create",
         "-h",
-        "https://pch-production.emg.illumina.com",
+        host,
         "-c", temp_file.name,
-       "-t", EMG_AUTH_TOKEN
+       "-t", token or EMG_AUTH_TOKEN
          #bearer_token_simplified
     ]
 
@@ -143,32 +184,39 @@ def batch_case_upload(temp_file):
     try:
       print(" ".join(command))
       result = subprocess.run(command, capture_output=True, text=True, check=True)
-      return result.stdout
+      return True, result.stdout
     except subprocess.CalledProcessError as e:
       print(f"Error executing batchCasesCreator: {e}")
-      return e.stderr
+      return False, e.stderr
 
-# bedIDsDF = read_excel("/mnt/genomics/R_and_D/wes/refFiles/TestingBED_IDs.xlsx",header=None,names=["CGL","bed_id"])
-bedIDsDF = read_excel("/mnt/genomics/R_and_D/wes/refFiles/ProductionIntersectBeds.xlsx",header=None,names=["CGL","bed_id"])
-bedIDs = {}
-for i,row in bedIDsDF.iterrows(): 
-    try:
-        bedIDs[row["CGL"]]=str(int(row["bed_id"]))
-    except:
-        bedIDs[row["CGL"]]= ''
-# bedIDs['CGLM0']=''
-# bedIDs['']=''
-
-# geneListIDs = read_excel("/mnt/genomics/R_and_D/wes/refFiles/TestingGeneIDs.xlsx",header=None,names=["CGL","Description","gene_id"])
-geneListIDs = read_excel("/mnt/genomics/R_and_D/wes/refFiles/ProductionGeneLists.xlsx",header=None,names=["CGL","gene_id"])
-geneLists={}
-for i,row in geneListIDs.iterrows(): geneLists[row["CGL"]]=str(int(row["gene_id"]))
-geneLists['']=''
-geneLists['CGLM0']=''
+def node_chunk_upload(rows, host=EMG_HOST, token=None):
+    """
+    Uploads a chunk of cases with batch_case_upload and returns a case result (see emg_submit.py) for every
+    case. BatchCasesCreator.js only reports on the whole batch, so every case gets the outcome of the chunk: a
+    chunk that failed may have created some of its cases, so they are "unknown" and not sent again. Its output
+    doesn't tell a rejected token apart, so the token should come from a login of this upload (EmgToken.verified).
+    """
+    start = perf_counter()
+    with NamedTemporaryFile(mode="w", delete=False) as temp_file:
+        write_batch_csv(temp_file, rows)
+        ok, output = batch_case_upload(temp_file, host, token)
+    print(output)
+    detail = (output or "").strip().replace('\t', ' ').replace('\n', ' ')[-200:]
+    return [case_result(row, "created" if ok else "unknown", detail=detail, seconds=perf_counter() - start) for row in rows]
+
+# The intersect bed and gene list IDs of every panel, loaded on first use (see emg_registry.py)
+# bedIDs = ReferenceIDs("/mnt/genomics/R_and_D/wes/refFiles/TestingBED_IDs.xlsx", "bed_id", lenient=True)
+bedIDs = ReferenceIDs("/mnt/genomics/R_and_D/wes/refFiles/ProductionIntersectBeds.xlsx", "bed_id", lenient=True)
+# geneLists = ReferenceIDs("/mnt/genomics/R_and_D/wes/refFiles/TestingGeneIDs.xlsx", "gene_id", extra={'': '', 'CGLM0': ''})
+geneLists = ReferenceIDs("/mnt/genomics/R_and_D/wes/refFiles/ProductionGeneLists.xlsx", "gene_id", extra={'': '', 'CGLM0': ''})
 
 if __name__ == "__main__":
     parser = create_parser()
     args = parser.parse_args()
+    if args.cprofile: recorder.start_profile()
+    with recorder.stage("emg_login"):
+        EMG_TOKEN = EmgToken(args.emg_host, username, password, use_cache=not args.no_token_cache)
+        EMG_AUTH_TOKEN = EMG_TOKEN.value
     print("*******************")
     print(EMG_AUTH_TOKEN)
     #print(bearer_token_simplified)    # 0. Inputs
@@ -177,37 +225,49 @@ if __name__ == "__main__":
     runFolder = args.analysis_id #"VS-Val-T1R-Samples-PCH_GermlineEnrichment_4-3-6_1-fcd27445-6f55-4fcb-b925-34ecc9221567"
 
     # 1. Read SampleSheet
-    samps = parseSampleSheet(sampleSheet)
+    with recorder.stage("parse_sample_sheet") as stage:
+        samps = parseSampleSheet(sampleSheet)
+        stage["rows"] = samps.shape[0]
 
-    # 2. Generate the batch csv file
-    csv_header= """[Data],,,,,,,,,,,,,,,,,,,,,,
-Family Id,Case Type,Files Names,Sample Type,BioSample Name,Visualization Files,Storage Provider Id,Default Project,Execute Now,Relation,Sex,Phenotypes,Phenotypes Id,Date Of Birth,Boost Genes,Gene List Id,Kit Id,Intersect Bed Id,Selected Preset,Label Id,Clinical Notes,Due Date,Opt In,
-"""
-
-    with NamedTemporaryFile(mode="w", delete=False) as temp_file:
-        # write header to the temporary file
-        temp_file.write(csv_header)
-        
-        # write each sample to the temp file
-        columns = [
-            "Family Id", "Case Type", "Files Names", "Sample Type", "BioSample Name", "Visualization Files", "Storage Provider Id", 
-            "Default Project", "Execute Now", "Relation", "Sex", "Phenotypes", "Phenotypes Id", "Date Of Birth", "Boost Genes", 
-            "Gene List Id", "Kit Id", "Intersect Bed Id", "Selected Preset", "Label Id", "Clinical Notes", "Due Date"
-        ]
+    # 2. Build the cases of every sample
+    with recorder.stage("reference_ids") as stage:
+        stage["rows"] = len(bedIDs) + len(geneLists)
+    with recorder.stage("build_cases") as stage:
+        cases = []
         for i, sample in samps.iterrows():
-            row, multi = build_sample(sample,runFolder)
+            row, multi = build_sample(sample, runFolder)
             pCount = 0
             while multi:
-                pCount+=1
-                row2, multi = build_sample(sample,runFolder,pCount)
-                for col in columns: temp_file.write(row2[col]+',')
-                temp_file.write("FALSE\n") #Opt In Value
-            
-            for col in columns: temp_file.write(row[col]+',')
-            temp_file.write("FALSE\n") #Opt In Value
-        
-        temp_file.flush()  # Ensure data is written to the file
-        
-        # batch upload the cases in the sample sheet
-        print(batch_case_upload(temp_file))
+                pCount += 1
+                row2, multi = build_sample(sample, runFolder, pCount)
+                cases.append(row2)
+            cases.append(row)
+        stage["rows"] = samps.shape[0]
+
+    # 3. batch upload the cases in chunks, keeping the result of every case in the state file
+    # Cases that the upload ledger shows were created before (e.g. by an earlier try of this upload) are not sent again
+    # The cases are created with BatchCasesCreator.js only: the request of emg_submit.submit_cases isn't verified
+    # against the Emedgene API yet
+    def send_cases(rows):
+        return node_chunk_upload(rows, args.emg_host, EMG_TOKEN.verified())
+
+    environment = EMG_ENVIRONMENT if args.emg_host == EMG_HOST else args.emg_host
+    ledger = args.ledger or default_ledger()
+    def upload_chunk(rows):
+        if args.no_ledger:
+            return send_cases(rows)
+        return submit_once(ledger, environment, runFolder, rows, send_cases)
+
+    stateName = args.state_file or os.path.basename(runFolder.rstrip('/')) + ".emg_upload.state.json"
+    with recorder.stage("batch_upload") as stage:
+        try:
+            results = submit_chunks(cases, upload_chunk, stateName, args.chunk_size, args.parallel_chunks, args.resume)
+        except (OSError, ValueError) as e:
+            parser.error(f"Could not use the state file {stateName}: {e}")
+        failed = print_results(results)
+        stage["rows"] = len(cases)
+
+    if args.cprofile: recorder.dump_profile(args.cprofile)
+    if args.timings: recorder.write(os.path.basename(runFolder.rstrip('/')) + ".emg_upload.timings.json", samples=samps.shape[0])
+    if failed: exit(1)
         
@@ -0,0 +1,132 @@
+from argparse import ArgumentParser
+from glob import glob
+from multiprocessing import Pool
+from os import cpu_count, makedirs
+from os.path import basename, exists, join
+from sys import exit
+from time import perf_counter
+from traceback import format_exc
+from CovReportConglomeration import getPanelName, getPanelSampleNames, parseSampleSheet, processSample, readPanelBed, timingsName
+from coverage_reader import tabix_index_path
+from instrumentation import StageRecorder
+
+FULL_RES_SUFFIX = ".qc-coverage-region-1_full_res.bed"
+
+# The options used for running this script
+def create_parser():
+    parser = ArgumentParser(description="Create the panel and gene coverage files for every sample of a run using a pool of processes.")
+
+    # Required arguments
+    parser.add_argument("-r", "--run_folder", type=str, required=True,
+                        help="The run folder that is searched (recursively) for the full resolution BED files (<sample>.qc-coverage-region-1_full_res.bed, "
+                             "or <sample>.qc-coverage-region-1_full_res.bed.gz with a tabix index).")
+    parser.add_argument("-s", "--sample_sheet", type=str, required=True,
+                        help="An Illumina V2 sample sheet with the panel bed information in the \"Description\" column of the Cloud Data.")
+    parser.add_argument("-b", "--panel_bed_folder", type=str, required=True,
+                        help="The folder where all the panel bed files are located.")
+
+    # Optional arguments
+    parser.add_argument("-o", "--out_dir", type=str, default="",
+                        help="The folder where the <sample_name> output folders are created (default: the current folder).")
+    parser.add_argument("-p", "--processes", type=int, default=cpu_count(),
+                        help="The number of samples processed at the same time (default: the number of CPUs).")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Folder for the binary coverage caches of the full resolution BED files. Defaults to the coverage folder of the local cache.")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Always parse the full resolution and panel BED files and don't read or write the binary coverage or panel bed caches.")
+    parser.add_argument("--thresholds", type=lambda t: [int(x) for x in t.split(',')], default=[0, 10, 20, 50, 100],
+                        help="Comma separated depth thresholds for the %%Bases columns (default: 0,10,20,50,100).")
+    parser.add_argument("--panels", type=lambda t: t.split(','), default=[],
+                        help="Comma separated CGLs whose coverage is added to every output next to the panels of the sample sheet.")
+    parser.add_argument("--union", action="store_true",
+                        help="Compute the exon coverage of every sample once for the union of all the panel beds in the panel bed folder and project every panel from it.")
+    parser.add_argument("--cohort_db", type=str, default=None,
+                        help="A cohort store (SQLite database, see cohort_store.py) the gene and panel metrics of every sample are added to.")
+    parser.add_argument("--run_name", type=str, default=None,
+                        help="The run name stored with the samples in the cohort store (default: the name of the run folder).")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute every panel, even when the manifest next to an existing output shows that its inputs are unchanged.")
+    parser.add_argument("--timings", action="store_true",
+                        help="Write the wall time, CPU time, peak memory and row count of every step next to each output (<sample_name>.qc_coverage_by_level.timings.json).")
+    return parser
+
+# Function to find the full resolution BED file of every sample in a run folder, a bgzipped one with a tabix index first
+def findFullResBeds(runFolder):
+    fullResBeds = {}
+    for suffix in (FULL_RES_SUFFIX + ".gz", FULL_RES_SUFFIX):
+        for fullResCov in sorted(glob(join(runFolder, "**", "*" + suffix), recursive=True)):
+            if suffix.endswith(".gz") and not tabix_index_path(fullResCov): continue
+            fullResBeds.setdefault(basename(fullResCov)[:-len(suffix)], fullResCov)
+    return dict(sorted(fullResBeds.items()))
+
+# The sample sheet and panel beds are parsed once by the parent and handed to every worker when the pool starts
+_shared = {}
+
+def _initWorker(sampleSheetDF, panelBeds, options):
+    _shared["sampleSheetDF"] = sampleSheetDF
+    _shared["panelBeds"] = panelBeds
+    _shared["options"] = options
+
+def _runSample(job):
+    sampleName, fullResCov = job
+    start = perf_counter()
+    recorder = StageRecorder()
+    try:
+        outName = processSample(fullResCov, sampleName, _shared["sampleSheetDF"], _shared["options"]["bedFolder"],
+                                outDir=_shared["options"]["outDir"], useCache=_shared["options"]["useCache"],
+                                cacheDir=_shared["options"]["cacheDir"], thresholds=_shared["options"]["thresholds"],
+                                panelBeds=_shared["panelBeds"], recorder=recorder, force=_shared["options"]["force"],
+                                cohortDb=_shared["options"]["cohortDb"], runName=_shared["options"]["runName"],
+                                union=_shared["options"]["union"], extraPanels=_shared["options"]["extraPanels"])
+        if _shared["options"]["timings"]: recorder.write(timingsName(outName), sample=sampleName)
+        return sampleName, "done", perf_counter() - start, outName
+    except Exception as e:
+        print(f"Error creating the coverage report for {sampleName}: {e}\n{format_exc()}")
+        return sampleName, "failed", perf_counter() - start, str(e).replace('\t', ' ').replace('\n', ' ')
+
+if __name__ == "__main__":
+    parser = create_parser()
+    args = parser.parse_args()
+
+    # Check if files exist
+    if not exists(args.sample_sheet): parser.error(f"The sample sheet '{args.sample_sheet}' does not exist!")
+    if not exists(args.run_folder): parser.error(f"The run folder '{args.run_folder}' does not exist!")
+
+    sampleSheetDF = parseSampleSheet(args.sample_sheet)
+    fullResBeds = findFullResBeds(args.run_folder)
+    print("Found %i full resolution BED files in %s" % (len(fullResBeds), args.run_folder))
+
+    #################### Parse every panel bed the run needs once ####################
+    status = []
+    jobs = []
+    panelBeds = {}
+    for sampleName, fullResCov in fullResBeds.items():
+        # Don't create reports for fill and PC samples
+        if sampleName.startswith("PC") or "fill" in sampleName.lower():
+            status.append((sampleName, "skipped", 0.0, "PC or fill sample"))
+            continue
+        try:
+            for cgl in [getPanelName(sampleSheetDF, samp, sampleName) for samp in getPanelSampleNames(sampleName)] + args.panels:
+                if cgl not in panelBeds: panelBeds[cgl] = readPanelBed(args.panel_bed_folder, cgl, not args.no_cache)
+        except Exception as e:
+            status.append((sampleName, "failed", 0.0, f"Could not get the panel bed of the sample: {e}"))
+            continue
+        jobs.append((sampleName, fullResCov))
+
+    #################### Create the coverage reports on a pool of processes ####################
+    options = {"bedFolder": args.panel_bed_folder, "outDir": args.out_dir, "useCache": not args.no_cache,
+               "cacheDir": args.cache_dir, "thresholds": args.thresholds, "timings": args.timings, "force": args.force, "union": args.union, "extraPanels": args.panels,
+               "cohortDb": args.cohort_db, "runName": args.run_name if args.run_name is not None else basename(args.run_folder.rstrip('/'))}
+    with Pool(max(1, min(args.processes, len(jobs))), initializer=_initWorker, initargs=(sampleSheetDF, panelBeds, options)) as pool:
+        status.extend(pool.imap_unordered(_runSample, jobs))
+
+    #################### Write the run level status summary ####################
+    if args.out_dir: makedirs(args.out_dir, exist_ok=True)
+    statusName = join(args.out_dir, "coverage_batch_status.tsv")
+    with open(statusName, "w") as fh:
+        fh.write("sample\tstatus\tseconds\tdetail\n")
+        for sampleName, sampleStatus, seconds, detail in sorted(status):
+            fh.write("%s\t%s\t%.1f\t%s\n" % (sampleName, sampleStatus, seconds, detail))
+    counts = {sampleStatus: sum(1 for s in status if s[1] == sampleStatus) for sampleStatus in ["done", "failed", "skipped"]}
+    print("Created %(done)i coverage reports, %(failed)i failed and %(skipped)i skipped." % counts, "Status written to", statusName)
+    if counts["failed"]: exit(1)
@@ -1,12 +1,21 @@
 from argparse import ArgumentParser
-from bisect import bisect_left
+from contextlib import nullcontext
 from datetime import datetime
-from openpyxl import load_workbook
-from os import makedirs
-from os.path import exists, join
-from pandas import concat, DataFrame, ExcelWriter, isna, read_csv, Series, to_numeric
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from glob import glob
+from os import getpid, makedirs, remove, replace
+from os.path import abspath, basename, dirname, exists, join, splitext
+import numpy as np
+from pandas import concat, DataFrame, isna, read_csv, read_excel, Series, to_numeric
 from pickle import load, dump
 from sys import exit
+from coverage_parallel import SharedCoverage, chrom_coverage_stats
+from coverage_reader import read_full_res_coverage, read_region_coverage, tabix_index_path
+from instrumentation import StageRecorder
+from coverage_cache import PANEL_BED_COLUMNS, file_digest, load_coverage_cache, load_panel_bed, warm_panel_bed_cache, write_coverage_cache
+from cohort_store import add_report, add_workbook, has_report
+from coverage_manifest import code_version, manifest_path, read_manifest, reusable_panels, write_manifest
 
 # The options used for running this script
 def create_parser():
@@ -14,13 +23,37 @@ def create_parser():
 
     # Required arguments
     parser.add_argument("-f", "--full_res", type=str, required=True,
-                        help="Path to the full resolution BED file from the 'full_res' report (<sample>.qc-coverage-region-1_full_res.bed) in ICA for a specific sample.")
+                        help="Path to the full resolution BED file from the 'full_res' report (<sample>.qc-coverage-region-1_full_res.bed) in ICA for a specific sample. A bgzipped file with a tabix index (<file>.bed.gz.tbi) is read only over the panel regions.")
     parser.add_argument("-s", "--sample_sheet", type=str, required=True,
                         help="An Illumina V2 sample sheet with the panel bed information in the \"Description\" column of the Cloud Data.")
     parser.add_argument("-n", "--sample_name", type=str, required=True,
                         help="The name of the sample so that the output goes to the correct folder and for naming of the output (<sample_name>.qc_coverage_by_level.xlsx")
     parser.add_argument("-b", "--panel_bed_folder", type=str, required=True,
                         help="The folder where all the panel bed files are located.")
+
+    # Optional arguments
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="The number of processes the exon coverage of the chromosomes is spread over (default: 1). Set it to the cpus of the task.")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Folder for the binary coverage cache of the full resolution BED file. Defaults to the coverage folder of the local cache.")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Always parse the full resolution and panel BED files and don't read or write the binary coverage or panel bed caches.")
+    parser.add_argument("--thresholds", type=lambda t: [int(x) for x in t.split(',')], default=[0, 10, 20, 50, 100],
+                        help="Comma separated depth thresholds for the %%Bases columns (default: 0,10,20,50,100). The 0 threshold counts bases with any coverage.")
+    parser.add_argument("--panels", type=lambda t: t.split(','), default=[],
+                        help="Comma separated CGLs whose coverage is added to the output next to the panels of the sample sheet.")
+    parser.add_argument("--union", action="store_true",
+                        help="Compute the exon coverage once for the union of all the panel beds in the panel bed folder, keep it next to the output (<sample_name>.qc_coverage_by_level.exon_stats.pkl) and project every panel from it.")
+    parser.add_argument("--cohort_db", type=str, default=None,
+                        help="A cohort store (SQLite database, see cohort_store.py) the gene and panel metrics of the sample are added to.")
+    parser.add_argument("--run_name", type=str, default="",
+                        help="The run name stored with the sample in the cohort store.")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute every panel, even when the manifest next to an existing output shows that its inputs are unchanged.")
+    parser.add_argument("--timings", action="store_true",
+                        help="Write the wall time, CPU time, peak memory and row count of every step next to the output (<sample_name>.qc_coverage_by_level.timings.json).")
+    parser.add_argument("--cprofile", type=str, default=None,
+                        help="Run the script under cProfile and save the profile to this path.")
     return parser
 
 # Function to parse an Illumina V2 sample sheet
@@ -61,10 +94,8 @@ def getSampleIndex(sampleNameParts, multiSampleName):
     
     return parts2.index(sampleNamePart)
 
-# Function to get the bed file in a DataFrame
-def getPanelBed(sampleSheetDF, sampleName, panelBedFolder,multiSampleName):
-    
-    print("Calculating coverage metrics for",sampleName)
+# Function to get the panel (CGL) of a sample from the sample sheet
+def getPanelName(sampleSheetDF, sampleName, multiSampleName):
     cglString = str(sampleSheetDF[sampleSheetDF["sample"]==multiSampleName]["panel(s)"].values[0])
     cglIndex = 0
     if sampleName != multiSampleName:
@@ -73,60 +104,131 @@ def getPanelBed(sampleSheetDF, sampleName, panelBedFolder,multiSampleName):
 
     cgl = cgls[cglIndex]
     if "CGL" not in cgl and cglString.startswith("CGL"): cgl = "CGL" + cgl
+    return cgl
+
+# Function to read a panel bed, from the local panel bed cache unless useCache is False
+def readPanelBed(panelBedFolder, cgl, useCache=True):
+    if useCache: return load_panel_bed(panelBedFolder, cgl)
+    return read_csv(join(panelBedFolder,cgl+".bed"),names=PANEL_BED_COLUMNS,sep='\t') # ,"transcript_ID","exon_number","panel"
 
-    headerColumns = ["chrom","start","end","exIDs","gene"] # ,"transcript_ID","exon_number","panel"
-    cglCoords = read_csv(join(panelBedFolder,cgl+".bed"),names=headerColumns,sep='\t')
+# Function to get a panel bed from the already parsed panel beds (CGL -> DataFrame) or else from the panel bed folder
+def loadPanelBed(panelBedFolder, cgl, panelBeds=None, useCache=True):
+    if panelBeds is not None and cgl in panelBeds: cglCoords = panelBeds[cgl].copy()
+    else: cglCoords = readPanelBed(panelBedFolder, cgl, useCache)
     cglCoords["Panel"] = cgl
+    return cglCoords
 
-    return cglCoords,cgl
+# Function to get the bed file in a DataFrame
+def getPanelBed(sampleSheetDF, sampleName, panelBedFolder,multiSampleName,panelBeds=None,useCache=True):
+    '''
+    getPanelBed returns the bed file of the sample's panel and the panel name. panelBeds is an optional dictionary
+    of already parsed panel beds (CGL -> DataFrame) that is used instead of reading the bed file again. Other panel
+    beds come from the local panel bed cache unless useCache is False.
+    '''
+    print("Calculating coverage metrics for",sampleName)
+    cgl = getPanelName(sampleSheetDF, sampleName, multiSampleName)
+    return loadPanelBed(panelBedFolder, cgl, panelBeds, useCache),cgl
 
-def exonCoverage(exon, coverage_data_sorted,covByCoverage):
-    start_index = bisect_left(coverage_data_sorted, (exon["chrom"], exon.start))
+# Function to get the sample names of each panel in a (multi-)sample name
+def getPanelSampleNames(sampleName):
+    panelSamples = []
+    for samp in sampleName.split('_'):
+        if "NGS" not in samp:
+            last_two_digits = str(datetime.now().year)[-2:]
+            samp = "NGS" + last_two_digits + '-' +samp
+        panelSamples.append(samp)
+    return panelSamples
 
-    # Iterate forward and collect overlapping intervals
-    overlapping_intervals = []
-    for i in range(start_index-1, len(coverage_data_sorted)):
-        chrom, start, end, coverage = coverage_data_sorted[i]
-        if chrom != exon["chrom"] or start > exon.end: break # Use .chrom and .end
-        if end > exon.start: overlapping_intervals.append((start, end, coverage))
+# Function to index the full resolution coverage by chromosome
+def buildCoverageIndex(coverage_data):
+    '''
+    buildCoverageIndex turns the full resolution coverage DataFrame (chrom, start, end, coverage) into
+    a dictionary of chromosome -> (starts, ends, coverage) NumPy arrays sorted by start. The full
+    resolution report tiles each chromosome with non-overlapping intervals, so the ends are sorted too.
+    '''
+    covIndex = {}
+    for chrom, chromCov in coverage_data.groupby("chrom", sort=False):
+        order = np.argsort(chromCov["start"].to_numpy(), kind="stable")
+        covIndex[chrom] = (chromCov["start"].to_numpy()[order],
+                           chromCov["end"].to_numpy()[order],
+                           chromCov["coverage"].to_numpy()[order])
+    return covIndex
 
-    # Convert to DataFrame
-    exon_coverage = DataFrame(overlapping_intervals, columns=["start", "end", "coverage"])
-    
-    #Get AVG coverage
-    exon_coverage["dif"] = exon_coverage["end"] - exon_coverage["start"]
-    totalBases = exon_coverage["dif"].sum()
-    exon_coverage["prod"] = exon_coverage["coverage"] * exon_coverage["dif"]
-    if exon["gene"] in covByCoverage: covByCoverage[exon["gene"]] = concat([covByCoverage[exon["gene"]],exon_coverage])
-    else: covByCoverage[exon["gene"]] = exon_coverage
-    if totalBases == 0:
-        return Series({ 
-        'AVG Coverage': 0,
-        '%Bases > 0X': 0.0,
-        '%Bases > 10X': 0.0,
-        '%Bases > 20X': 0.0,
-        '%Bases > 50X': 0.0,
-        '%Bases > 100X': 0.0
-    })
-    
-    avgCov = exon_coverage["prod"].sum()/totalBases
-    percAbove_0x = exon_coverage[exon_coverage["coverage"]>0]["dif"].sum()/totalBases
-    percAbove_10x = exon_coverage[exon_coverage["coverage"]>=10]["dif"].sum()/totalBases
-    percAbove_20x = exon_coverage[exon_coverage["coverage"]>=20]["dif"].sum()/totalBases
-    percAbove_50x = exon_coverage[exon_coverage["coverage"]>=50]["dif"].sum()/totalBases
-    percAbove_100x = exon_coverage[exon_coverage["coverage"]>=100]["dif"].sum()/totalBases
-    
-    if exon["gene"] in covByCoverage: covByCoverage[exon["gene"]] = concat([covByCoverage[exon["gene"]],exon_coverage])
-    else: covByCoverage[exon["gene"]] = exon_coverage
+# Function to load the full resolution coverage once for every panel of a sample
+def loadCoverageIndex(fullResCov, panelChrs, useCache=True, cacheDir=None, panelRegions=None):
+    '''
+    loadCoverageIndex returns the per chromosome (starts, ends, coverage) index of the full resolution BED file for the
+    chromosomes the sample's panels use (panelChrs). The same index answers the exon overlaps of every panel in a multi-sample name.
+    A bgzipped full resolution BED file with a tabix index (<file>.bed.gz.tbi) is read region by region: only the
+    intervals overlapping panelRegions (chrom -> list of (start, end)) are fetched.
+    Otherwise, when useCache is set the index is memory-mapped from the binary sidecar of the full resolution BED file.
+    If the sidecar is missing or stale, the BED file is parsed a single time and the sidecar is written for later runs.
+    '''
+    if panelRegions is not None and tabix_index_path(fullResCov):
+        print("Reading the panel regions of the indexed Full resolution Coverage report")
+        coverage_data = read_region_coverage(fullResCov, panelRegions)
+        print("Coverage data in the panel regions:",coverage_data.shape[0])
+        return buildCoverageIndex(coverage_data)
 
-    return Series({ 
-        'AVG Coverage': avgCov,
-        '%Bases > 0X': percAbove_0x,
-        '%Bases > 10X': percAbove_10x,
-        '%Bases > 20X': percAbove_20x,
-        '%Bases > 50X': percAbove_50x,
-        '%Bases > 100X': percAbove_100x
-    })
+    if useCache:
+        covIndex = load_coverage_cache(fullResCov, panelChrs, cacheDir)
+        if covIndex is not None:
+            print("Using the cached Full resolution Coverage report")
+            return covIndex
+
+    print("Reading Full resolution Coverage report")
+    if useCache:
+        # The cache holds every chromosome, so later runs can serve panels on other chromosomes too
+        covIndex, rowsRead = read_full_res_coverage(fullResCov)
+        print("Writing the Full resolution Coverage cache")
+        write_coverage_cache(fullResCov, covIndex, cacheDir)
+        covIndex = {chrom: arrays for chrom, arrays in covIndex.items() if chrom in panelChrs}
+    else:
+        ##################### Remove any full coverage data on chromosomes not in the panels while reading ####################
+        covIndex, rowsRead = read_full_res_coverage(fullResCov, panelChrs)
+    print("Coverage data before filtering:",rowsRead)
+    print("Coverage data after filtering:",sum(len(starts) for starts, ends, coverage in covIndex.values()))
+    return covIndex
+
+def metricColumns(thresholds):
+    '''
+    metricColumns returns the names of the coverage metric columns for the given depth thresholds.
+    '''
+    return ["AVG Coverage"] + ["%%Bases > %iX" % (t) for t in thresholds]
+
+def exonCoverageStats(panelBed, covIndex, thresholds=(0, 10, 20, 50, 100), shared=None):
+    '''
+    exonCoverageStats calculates a fixed size coverage record for every exon in panelBed in one pass per chromosome:
+    the number of bases, the depth weighted sum of the bases and the number of bases above each threshold
+    (more than 0X for the 0 threshold, at least the threshold otherwise). An interval counts toward an exon
+    when it starts at or before the exon end and ends after the exon start, and it is weighted by its full length.
+    For each chromosome the first and last overlapping interval of every exon are found with searchsorted and the
+    sums are taken from prefix sums, so the records of genes and panels are just the sums of their exon records.
+    With a SharedCoverage of covIndex (shared) the chromosomes are computed in parallel by its worker processes.
+    The records only hold the bases above the given thresholds, so other thresholds need the coverage again: the
+    manifest and the union exon records are keyed on the thresholds.
+    '''
+    statCols = ["Bases", "Depth Sum"] + ["Bases > %iX" % (t) for t in thresholds]
+    stats = DataFrame(0.0, index=panelBed.index, columns=statCols)
+    chroms = [(chrom, exons) for chrom, exons in panelBed.groupby("chrom", sort=False) if chrom in covIndex]
+    tasks = [(chrom, exons["start"].to_numpy(), exons["end"].to_numpy()) for chrom, exons in chroms]
+    if shared is None: chromStats = [chrom_coverage_stats(*covIndex[chrom], exonStarts, exonEnds, thresholds) for chrom, exonStarts, exonEnds in tasks]
+    else: chromStats = shared.chrom_stats(tasks, thresholds)
+    for (chrom, exons), exonStats in zip(chroms, chromStats):
+        stats.loc[exons.index, statCols] = exonStats
+    return stats
+
+def coverageMetrics(stats, thresholds=(0, 10, 20, 50, 100)):
+    '''
+    coverageMetrics turns coverage records from exonCoverageStats (or sums of them) into the AVG Coverage and
+    %Bases columns. Records without any bases get zeros for every metric.
+    '''
+    metricCols = metricColumns(thresholds)
+    totalBases = stats["Bases"].where(stats["Bases"] > 0, 1)
+    metrics = DataFrame({metricCols[0]: stats["Depth Sum"] / totalBases}, index=stats.index)
+    for t, col in zip(thresholds, metricCols[1:]):
+        metrics[col] = stats["Bases > %iX" % (t)] / totalBases
+    return metrics
 
 def zero():
     return Series({ 
@@ -138,6 +240,222 @@ def zero():
         '%Bases > 100X': 0.0
     })
 
+# Function to write the coverage workbook in a single pass
+def writeCoverageWorkbook(outName, sheets, percentCols):
+    '''
+    writeCoverageWorkbook streams the (sheet name, DataFrame) pairs in sheets to a new workbook at outName, each sheet
+    with a header row, and formats the percentCols as percentages while the rows are written.
+
+    The workbook is saved to a temporary name and moved into place, so a crash leaves the previous workbook (and
+    its manifest) as it was, never a partial workbook under an old manifest.
+    '''
+    book = Workbook(write_only=True)
+    for sheetName, df in sheets:
+        worksheet = book.create_sheet(sheetName)
+        worksheet.append(list(df.columns))
+
+        percentIndices = [df.columns.get_loc(col) for col in percentCols if col in df.columns]
+        values = df.astype(object).where(df.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            row = list(row)
+            for i in percentIndices:
+                cell = WriteOnlyCell(worksheet, value=row[i])
+                cell.number_format = '0%'
+                row[i] = cell
+            worksheet.append(row)
+    book.save(outName + ".tmp%i" % (getpid()))
+    replace(outName + ".tmp%i" % (getpid()), outName)
+
+# Function to get the name of the stage timings sidecar of an output file
+def timingsName(outName):
+    return splitext(outName)[0] + ".timings.json"
+
+# Function to get the (sample, CGL) of every panel in the coverage workbook of a (multi-)sample, the panels from the sample sheet first
+def getPanelSpecs(sampleName, sampleSheetDF, extraPanels=()):
+    panelSpecs = [(samp, getPanelName(sampleSheetDF, samp, sampleName)) for samp in getPanelSampleNames(sampleName)]
+    return panelSpecs + [(sampleName, cgl) for cgl in extraPanels if cgl not in [spec[1] for spec in panelSpecs]]
+
+# Function to describe everything the coverage workbook of a (multi-)sample depends on
+def sampleManifest(fullResCov, sampleName, sampleSheetDF, bedFolder, thresholds, useCache=True, panelSpecs=None):
+    panelSpecs = panelSpecs or getPanelSpecs(sampleName, sampleSheetDF)
+    return {"sample": sampleName,
+            "full_res": file_digest(fullResCov, useCache),
+            "sample_sheet_row": str(sampleSheetDF[sampleSheetDF["sample"]==sampleName]["panel(s)"].values[0]),
+            "code_version": code_version(__file__, *[join(dirname(abspath(__file__)), module) for module in
+                                                      ("coverage_reader.py", "coverage_parallel.py", "coverage_cache.py")]),
+            "thresholds": list(thresholds),
+            "panels": [{"sample": samp, "cgl": cgl, "bed": file_digest(join(bedFolder, cgl + ".bed"), useCache)}
+                       for samp, cgl in panelSpecs]}
+
+#################### Union of panels mode ####################
+# The exon records of exonCoverageStats only depend on the exon coordinates and the coverage, so they are computed
+# once for the deduplicated union of the exons of every panel bed and kept next to the workbook
+# (<sample_name>.qc_coverage_by_level.exon_stats.pkl). Every panel is then projected from these records, and only
+# exons that aren't in them yet (e.g. from a new panel bed) need the full resolution coverage.
+def exonStatsName(outName):
+    return splitext(outName)[0] + ".exon_stats.pkl"
+
+# Function to get the deduplicated exons of all the panel beds in a folder
+def unionExons(panelBedFolder, panelBeds=None, useCache=True):
+    cgls = warm_panel_bed_cache(panelBedFolder) if useCache else sorted(basename(bed)[:-len(".bed")] for bed in glob(join(panelBedFolder, "*.bed")))
+    exons = concat([loadPanelBed(panelBedFolder, cgl, panelBeds, useCache)[["chrom", "start", "end"]] for cgl in cgls], ignore_index=True)
+    return exons.drop_duplicates(ignore_index=True)
+
+# Function to read the cached union exon records, if they were made from the same full resolution BED, code and thresholds
+def loadExonStats(statsName, key):
+    if not exists(statsName): return None
+    try:
+        with open(statsName, "rb") as fh: cached = load(fh)
+    except Exception:
+        return None
+    return cached["stats"] if cached.get("key") == key else None
+
+def saveExonStats(statsName, key, stats):
+    with open(statsName + ".tmp%i" % (getpid()), "wb") as fh: dump({"key": key, "stats": stats}, fh)
+    replace(statsName + ".tmp%i" % (getpid()), statsName)
+
+# Function to project the union exon records onto the exons of a panel bed
+def projectExonStats(panelBed, exonStats, thresholds):
+    statCols = ["Bases", "Depth Sum"] + ["Bases > %iX" % (t) for t in thresholds]
+    projected = panelBed[["chrom", "start", "end"]].merge(exonStats, on=["chrom", "start", "end"], how="left")
+    return projected[statCols].fillna(0.0).set_axis(panelBed.index)
+
+# Function to read the rows of a single panel from every sheet of an existing coverage workbook
+def readPanelSheets(outName):
+    sheets = read_excel(outName, sheet_name=None, dtype={"chrom": str, "exIDs": str, "gene": str, "Panel": str})
+    return {sheetName: {panelName: rows for panelName, rows in sheet.groupby("Panel", sort=False)} for sheetName, sheet in sheets.items()}
+
+# Function to create the coverage workbook of a (multi-)sample
+def processSample(fullResCov, sampleName, sampleSheetDF, bedFolder, outDir="", useCache=True, cacheDir=None, thresholds=(0, 10, 20, 50, 100), panelBeds=None, recorder=None, force=False, cohortDb=None, runName="", union=False, extraPanels=(), threads=1):
+    '''
+    processSample calculates the exon, gene and panel coverage of every panel in sampleName from the full
+    resolution BED file and saves them to <outDir>/<sampleName>/<sampleName>.qc_coverage_by_level.xlsx.
+    panelBeds is passed on to getPanelBed. The time and memory of every step are recorded in the optional
+    StageRecorder recorder. Returns the path of the workbook.
+    
+    A manifest is saved next to the workbook. Unless force is True, panels whose full resolution BED, panel
+    bed, sample sheet row, code and thresholds are unchanged since the last run are copied from the existing
+    workbook instead of being recomputed, and nothing is done at all when every panel is unchanged.
+    The gene and panel metrics are also added to the cohort store cohortDb when it is given.
+
+    The CGLs in extraPanels are added to the workbook after the panels of the sample sheet. With union, the exon
+    records are computed for the union of all the panel beds in bedFolder and every panel is projected from them.
+    With more than one thread the chromosomes are spread over that many worker processes (see SharedCoverage).
+    '''
+    recorder = recorder or StageRecorder()
+    outName = join(outDir, sampleName, f"{sampleName}.qc_coverage_by_level.xlsx")
+    panelSpecs = getPanelSpecs(sampleName, sampleSheetDF, extraPanels)
+    with recorder.stage("manifest"):
+        manifest = sampleManifest(fullResCov, sampleName, sampleSheetDF, bedFolder, thresholds, useCache, panelSpecs)
+        previous = None if force else read_manifest(outName)
+        reused = reusable_panels(previous, manifest)
+    # Only a workbook with exactly the same panels is left as is: a previous run may have had more (e.g. --panels)
+    if len(reused) == len(panelSpecs) and previous is not None and previous.get("panels") == manifest["panels"]:
+        print(f"The inputs of {outName} are unchanged, skipping {sampleName}.")
+        if cohortDb and not has_report(cohortDb, sampleName):
+            with recorder.stage("cohort_store"):
+                add_workbook(cohortDb, outName, runName)
+        return outName
+    if reused:
+        print("Reusing the coverage of %s from %s" % (", ".join(panelSpecs[i][1] for i in sorted(reused)), outName))
+        with recorder.stage("read_previous_workbook"):
+            previousSheets = readPanelSheets(outName)
+
+    with recorder.stage("panel_beds") as stage:
+        panels = {}
+        sheetPanels = len(getPanelSampleNames(sampleName))
+        for i, (samp, cgl) in enumerate(panelSpecs):
+            if i in reused: continue
+            if i < sheetPanels: panels[i] = getPanelBed(sampleSheetDF,samp,bedFolder,sampleName,panelBeds,useCache)
+            else: panels[i] = (loadPanelBed(bedFolder, cgl, panelBeds, useCache), cgl)
+        allExons = concat([panelBed[["chrom", "start", "end"]] for panelBed, panelName in panels.values()]).drop_duplicates() if panels \
+                   else DataFrame({"chrom": Series(dtype=object), "start": Series(dtype="int64"), "end": Series(dtype="int64")})
+        stage["rows"] = allExons.shape[0]
+
+    #################### Exon records of the union of all panel beds, only the exons that aren't cached yet are computed ####################
+    exonStats = None
+    makedirs(join(outDir, sampleName), exist_ok=True)
+    if union:
+        with recorder.stage("union_exons") as stage:
+            statsKey = {key: manifest[key] for key in ("full_res", "code_version", "thresholds")}
+            exonStats = None if force else loadExonStats(exonStatsName(outName), statsKey)
+            allExons = concat([unionExons(bedFolder, panelBeds, useCache), allExons]).drop_duplicates(ignore_index=True)
+            if exonStats is not None:
+                cached = allExons.merge(exonStats[["chrom", "start", "end"]], on=["chrom", "start", "end"], how="left", indicator=True)["_merge"] == "both"
+                allExons = allExons[~cached.to_numpy()]
+            print("Computing the exon records of %i union exons" % (allExons.shape[0]))
+            stage["rows"] = allExons.shape[0]
+
+    #################### Process the full resolution report once for all the panels of the sample ####################
+    # Nothing is loaded when every panel is reused and no union exon is missing
+    covIndex = None
+    computing = allExons.shape[0] > 0 if union else len(panels) > 0
+    if computing:
+        with recorder.stage("load_coverage") as stage:
+            panelChrs = set(allExons["chrom"].unique())
+            panelRegions = {chrom: list(zip(exons["start"], exons["end"] + 1)) for chrom, exons in allExons.groupby("chrom")} # Intervals starting at the exon end count too
+            covIndex = loadCoverageIndex(fullResCov, panelChrs, useCache, cacheDir, panelRegions)
+            stage["rows"] = sum(len(starts) for starts, ends, coverage in covIndex.values())
+    with SharedCoverage(covIndex, threads) if computing and threads > 1 else nullcontext() as shared:
+        if union and allExons.shape[0]:
+            with recorder.stage("exon_coverage", rows=allExons.shape[0]):
+                newStats = concat([allExons.reset_index(drop=True), exonCoverageStats(allExons.reset_index(drop=True), covIndex, thresholds, shared)], axis=1)
+                exonStats = newStats if exonStats is None else concat([exonStats, newStats], ignore_index=True)
+                saveExonStats(exonStatsName(outName), statsKey, exonStats)
+        metricCols = metricColumns(thresholds)
+
+        exonSheets, geneSheets, panelSheets = [], [], []
+        for i in range(len(panelSpecs)):
+            if i in reused:
+                panelName = panelSpecs[i][1]
+                exonSheets.append(previousSheets["Exon Coverage"][panelName])
+                geneSheets.append(previousSheets["Gene Coverage"][panelName])
+                panelSheets.append(previousSheets["Panel Coverage"][panelName])
+                continue
+            panelBed, panelName = panels[i]
+
+            #################### process the remaining lines in the full resolution report, saving all regions to a list for deeper processing ####################
+            print("Calculating exon coverage.")
+            with recorder.stage("exon_coverage" if exonStats is None else "project_exons", rows=panelBed.shape[0]):
+                if exonStats is None: panelExonStats = exonCoverageStats(panelBed, covIndex, thresholds, shared)
+                else: panelExonStats = projectExonStats(panelBed, exonStats, thresholds)
+                panelBed[metricCols] = coverageMetrics(panelExonStats, thresholds)
+
+            #################### The gene records are the sums of their exon records, genes without any coverage are left out ####################
+            print("Calculating gene coverage for %i genes" % (panelBed["gene"].nunique()))
+            with recorder.stage("gene_coverage") as stage:
+                geneStats = panelExonStats.groupby(panelBed["gene"], sort=False).sum()
+                geneStats = geneStats[geneStats["Bases"] > 0]
+                panelGeneCov = coverageMetrics(geneStats, thresholds).rename_axis("gene").reset_index()
+                stage["rows"] = panelGeneCov.shape[0]
+
+            #################### The panel record is the sum of all the gene records ####################
+            print("Calculating panel coverage")
+            with recorder.stage("panel_coverage", rows=1):
+                panelCov = coverageMetrics(geneStats.sum().to_frame().T, thresholds)
+                panelCov.insert(0, "Panel", panelName)
+        
+            panelBed["Panel"] = panelName
+            panelGeneCov["Panel"] = panelName
+            exonSheets.append(panelBed)
+            geneSheets.append(panelGeneCov)
+            panelSheets.append(panelCov)
+
+    #################### Save the workbook, then its manifest. The old manifest goes first, it doesn't describe the new workbook ####################
+    print(outName)
+    with recorder.stage("write_workbook", rows=sum(df.shape[0] for df in exonSheets)):
+        if exists(manifest_path(outName)): remove(manifest_path(outName))
+        writeCoverageWorkbook(outName, [("Exon Coverage", concat(exonSheets, ignore_index=True)),
+                                        ("Gene Coverage", concat(geneSheets, ignore_index=True)),
+                                        ("Panel Coverage", concat(panelSheets, ignore_index=True))], metricCols[1:])
+        write_manifest(outName, manifest)
+
+    if cohortDb:
+        with recorder.stage("cohort_store"):
+            add_report(cohortDb, sampleName, [spec[0] for spec in panelSpecs], concat(geneSheets, ignore_index=True), concat(panelSheets, ignore_index=True), runName)
+
+    return outName
+
 if __name__ == "__main__":
     parser = create_parser()
     args = parser.parse_args()
@@ -145,7 +463,6 @@ if __name__ == "__main__":
     # Access the arguments
     fullResCov = args.full_res 
     sampleName = args.sample_name 
-    outName = f"{sampleName}/{sampleName}.qc_coverage_by_level.xlsx"
     sampleSheet = args.sample_sheet
     bedFolder = args.panel_bed_folder
 
@@ -156,148 +473,15 @@ if __name__ == "__main__":
     if not exists(sampleSheet): parser.error(f"The sample sheet '{sampleSheet}' does not exist!")
     if not exists(fullResCov): parser.error(f"The full resolution coverage file '{fullResCov}' does not exist!")
 
-    #################### Process the target coverage report ####################
-    sampleSheetDF = parseSampleSheet(sampleSheet)
-
-    for sampleIndex,samp in enumerate(sampleName.split('_')):
-        if "NGS" not in samp:
-            last_two_digits = str(datetime.now().year)[-2:]
-            samp = "NGS" + last_two_digits + '-' +samp
-        panelBed, panelName = getPanelBed(sampleSheetDF,samp,bedFolder,sampleName)
-        panelChrs = set(panelBed["chrom"].unique())
-        
-        #################### Process the full resolution report ####################
-        # Load the full-resolution coverage BED file into a DataFrame
-        print("Reading Full resolution Coverage report")
-        coverage_data = read_csv(fullResCov, sep="\t", header=None, names=["chrom", "start", "end", "coverage"])
-
-        ##################### Remove any full coverage data on chromosomes not in the panel ####################  
-        print("Coverage data before filtering:",coverage_data.shape[0])
-        coverage_data = coverage_data[coverage_data["chrom"].isin(panelChrs)].reset_index(drop=True)
-        
-        print("Coverage data after filtering:",coverage_data.shape[0])
-        coverage_data_sorted = sorted(zip(coverage_data['chrom'], coverage_data['start'], coverage_data['end'], coverage_data['coverage']))
-        
-        #################### process the remaining lines in the full resolution report, saving all regions to a list for deeper processing ####################
-        print("Calculating exon coverage.")
-        covByCoverage={}
-        panelBed[["AVG Coverage","%Bases > 0X","%Bases > 10X","%Bases > 20X","%Bases > 50X","%Bases > 100X"]]= panelBed.apply(lambda exon: exonCoverage(exon, coverage_data_sorted,covByCoverage), axis=1)
-
-        #################### covByCoverage now contains genes and each gene has a list of all the exons that fall within the gene
-        # the next step goes through each gene and calculates coverage and percent bases covered ####################
-        panelGeneNames = panelBed["gene"].unique()
-        print("Calculating gene coverage for %i genes" % (len(panelGeneNames)))
-        cols = ["gene","AVG Coverage","%Bases > 0X","%Bases > 10X","%Bases > 20X","%Bases > 50X","%Bases > 100X"]
-        panelGeneCov = DataFrame(columns=cols)
-        allPanelCoverage = None
-        for i,gene in enumerate(panelGeneNames):
-            allExonCov = covByCoverage[gene]
-            totalBases = allExonCov["dif"].sum()
-            if totalBases == 0: continue
-        
-            if i == 0: allPanelCoverage = allExonCov
-            else: allPanelCoverage = concat([allPanelCoverage,allExonCov])
-            
-            avgCov = allExonCov["prod"].sum()/totalBases
-            percAbove_0x = allExonCov[allExonCov["coverage"]>0]["dif"].sum()/totalBases
-            percAbove_10x = allExonCov[allExonCov["coverage"]>=10]["dif"].sum()/totalBases
-            percAbove_20x = allExonCov[allExonCov["coverage"]>=20]["dif"].sum()/totalBases
-            percAbove_50x = allExonCov[allExonCov["coverage"]>=50]["dif"].sum()/totalBases
-            percAbove_100x = allExonCov[allExonCov["coverage"]>=100]["dif"].sum()/totalBases
-            panelGeneCov.loc[panelGeneCov.shape[0],cols] = Series({ 
-                'gene': gene,
-                'AVG Coverage': avgCov,
-                '%Bases > 0X': percAbove_0x,
-                '%Bases > 10X': percAbove_10x,
-                '%Bases > 20X': percAbove_20x,
-                '%Bases > 50X': percAbove_50x,
-                '%Bases > 100X': percAbove_100x
-            })
-        
-        #################### The previous step saved all the genes in the panel to the same list of exons. Now this step will process all the exons together ####################
-        print("Calculating panel coverage")
-        cols = ["Panel","AVG Coverage","%Bases > 0X","%Bases > 10X","%Bases > 20X","%Bases > 50X","%Bases > 100X"]
-        panelCov = DataFrame(columns=cols)
-        
-        totalBases = allPanelCoverage["dif"].sum()
-        avgCov = allPanelCoverage["prod"].sum()/totalBases
-        percAbove_0x = allPanelCoverage[allPanelCoverage["coverage"]>0]["dif"].sum()/totalBases
-        percAbove_10x = allPanelCoverage[allPanelCoverage["coverage"]>=10]["dif"].sum()/totalBases
-        percAbove_20x = allPanelCoverage[allPanelCoverage["coverage"]>=20]["dif"].sum()/totalBases
-        percAbove_50x = allPanelCoverage[allPanelCoverage["coverage"]>=50]["dif"].sum()/totalBases
-        percAbove_100x = allPanelCoverage[allPanelCoverage["coverage"]>=100]["dif"].sum()/totalBases
-        
-        panelCov.loc[0,cols] = Series(
-            {'Panel': panelName,
-            'AVG Coverage': avgCov,
-            '%Bases > 0X': percAbove_0x,
-            '%Bases > 10X': percAbove_10x,
-            '%Bases > 20X': percAbove_20x,
-            '%Bases > 50X': percAbove_50x,
-            '%Bases > 100X': percAbove_100x}
-        )
-        
-        #################### Step to ensure the results are saved to an existing directory containing the sample ####################
-        makedirs(sampleName, exist_ok=True)
-
-        print(outName)
-        percent_cols = ['%Bases > 0X', '%Bases > 10X', '%Bases > 20X', '%Bases > 50X', '%Bases > 100X']
-        if exists(outName):
-            # Load the existing workbook
-            book = load_workbook(outName)
-        
-            with ExcelWriter(outName, engine='openpyxl', mode='a', if_sheet_exists='overlay') as writer:
-                # Automatically maps existing sheets (no need to set `writer.book`)
-                panelBed["Panel"] = panelName
-                panelGeneCov["Panel"] = panelName
-        
-                # Find the last row in each sheet
-                startrow_exon = book['Exon Coverage'].max_row
-                startrow_gene = book['Gene Coverage'].max_row
-                startrow_panel = book['Panel Coverage'].max_row
-        
-                # Append data to existing sheets
-                panelBed.to_excel(writer, sheet_name='Exon Coverage', index=None, startrow=startrow_exon, header=False)
-                panelGeneCov.to_excel(writer, sheet_name='Gene Coverage', index=None, startrow=startrow_gene, header=False)
-                panelCov.to_excel(writer, sheet_name='Panel Coverage', index=None, startrow=startrow_panel, header=False)
-        
-            # Reopen workbook to apply formatting
-            book = load_workbook(outName)
-        
-            for sheet_name, df in zip(['Panel Coverage', 'Gene Coverage', 'Exon Coverage'], [panelCov, panelGeneCov, panelBed]):
-                worksheet = book[sheet_name]
-                col_indices = [df.columns.get_loc(col) + 1 for col in percent_cols]  # +1 to match Excel's 1-based columns
-        
-                for col_num in col_indices:
-                    for row in worksheet.iter_rows(min_row=2, min_col=col_num, max_col=col_num):  # Skip header
-                        for cell in row:
-                            cell.number_format = '0%'  # Apply percentage format
-        
-            book.save(outName)  # Save changes
-        
-        else:
-            # Create a new Excel file if it doesn't exist
-            with ExcelWriter(outName, engine='openpyxl', mode='w') as writer:
-                panelBed["Panel"] = panelName
-                panelGeneCov["Panel"] = panelName
-                panelBed.to_excel(writer, sheet_name='Exon Coverage', index=None)
-                panelGeneCov.to_excel(writer, sheet_name='Gene Coverage', index=None)
-                panelCov.to_excel(writer, sheet_name='Panel Coverage', index=None)
-        
-            # Apply formatting after saving
-            book = load_workbook(outName)
-        
-            for sheet_name, df in zip(['Panel Coverage', 'Gene Coverage', 'Exon Coverage'], [panelCov, panelGeneCov, panelBed]):
-                worksheet = book[sheet_name]
-                col_indices = [df.columns.get_loc(col) + 1 for col in percent_cols]
-        
-                for col_num in col_indices:
-                    for row in worksheet.iter_rows(min_row=2, min_col=col_num, max_col=col_num):  # Skip header
-                        for cell in row:
-                            cell.number_format = '0%'
-        
-            book.save(outName)  # Save changes
-
-
+    recorder = StageRecorder()
+    if args.cprofile: recorder.start_profile()
 
+    #################### Process the target coverage report ####################
+    with recorder.stage("sample_sheet"):
+        sampleSheetDF = parseSampleSheet(sampleSheet)
 
+    outName = processSample(fullResCov, sampleName, sampleSheetDF, bedFolder, useCache=not args.no_cache, cacheDir=args.cache_dir,
+                            thresholds=args.thresholds, recorder=recorder, force=args.force,
+                            cohortDb=args.cohort_db, runName=args.run_name, union=args.union, extraPanels=args.panels, threads=args.threads)
+    if args.cprofile: recorder.dump_profile(args.cprofile)
+    if args.timings: recorder.write(timingsName(outName), sample=sampleName)
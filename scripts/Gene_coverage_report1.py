@@ -1,120 +1,494 @@
 import os
 import argparse
+import pickle
+import re
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatchcase
+from io import BytesIO
+from math import nan
+from openpyxl import load_workbook
 import pandas as pd
 from docx import Document
+from docx.shared import Emu
+from xml.sax.saxutils import escape
+from instrumentation import StageRecorder
 
-# Argument parser to get the root directory from user input
-parser = argparse.ArgumentParser(description='Process coverage QC Excel files.')
-parser.add_argument(
-    '-d', '--directory',
-    required=True,
-    help='Root directory containing the Excel files'
-)
-args = parser.parse_args()
-root_dir = args.directory
+# The results of read_workbook are kept in this file under the root directory, next to the Word document, so
+# a rerun on a growing directory only reads the new and changed workbooks
+SUMMARY_CACHE_NAME = '.gene_coverage_summary.cache'
+SUMMARY_CACHE_VERSION = 1
 
-panel_info = {}    # Holds (panel_name, %>=20x)
-gene_lists = {}    # Holds [(gene_name, italic), ...]
+# With --index, the file and subdirectory listing of every directory is kept in this file under the root directory,
+# so a rescan of a large (network) directory tree only lists the directories that changed
+LISTING_INDEX_NAME = '.gene_coverage_listing.index'
+LISTING_INDEX_VERSION = 1
+RACY_LISTING_NS = 2 * 10 ** 9
 
-for subdir, _, files in os.walk(root_dir):
-    for file in files:
-        if file.endswith('.xlsx') and not file.startswith('~$'):
-            file_path = os.path.join(subdir, file)
+# Directories that never hold coverage workbooks but can be huge: NFS snapshots and Nextflow and git metadata
+PRUNE_DIRS = ['.snapshot', '.nextflow', '.git']
 
-            # Read from Panel Coverage sheet: %>=20x (E1) and Panel Name (B1)
-            try:
-                df_panel = pd.read_excel(
-                    file_path,
-                    sheet_name='Panel Coverage',
-                    usecols='B,E',
-                    nrows=1,
-                    engine='openpyxl'
-                )
-                panel_name = df_panel.iloc[0, 0]
-                value = df_panel.iloc[0, 1]
-
-                if isinstance(value, str) and '%' in value:
-                    value = value.replace('%', '').strip()
-                value = float(value) * 100  # Convert to percentage
-
-                panel_info[file] = (panel_name, value)
-
-            except Exception as e:
-                print(f"Error reading Panel Coverage in {file_path}: {e}")
-                panel_info[file] = ("N/A", "N/A")
-                continue
-
-            # Read Gene Coverage sheet
-            try:
-                df_gene = pd.read_excel(
-                    file_path,
-                    sheet_name='Gene Coverage',
-                    engine='openpyxl'
-                )
-
-                genes = df_gene.iloc[0:, 0].tolist()
-                coverages = df_gene.iloc[0:, 4].tolist()
-
-                genes_with_format = []
-                for gene, cov in zip(genes, coverages):
-                    if pd.isna(gene):
-                        continue
-                    try:
-                        cov_val = float(cov)
-                    except (ValueError, TypeError):
-                        cov_val = 100
-
-                    gene_str = str(gene)
-                    if cov_val < 0.95:
-                        genes_with_format.append((gene_str + '*', True))  # Low coverage
-                    else:
-                        genes_with_format.append((gene_str, True))  # Italic regardless
-
-                # Sort genes alphabetically
-                gene_lists[file] = sorted(genes_with_format, key=lambda x: x[0].lower())
-
-            except Exception as e:
-                print(f"Error reading Gene Coverage in {file_path}: {e}")
-                gene_lists[file] = []
-
-# Create Word document with table and sorted gene list
-doc = Document()
-doc.add_heading('Gene Coverage Summary', 0)
-
-for file in sorted(gene_lists.keys()):
-    panel_name, coverage_pct = panel_info.get(file, ("N/A", "N/A"))
-
-    doc.add_heading(f"File: {file}", level=1)
-
-    # Add summary table
-    table = doc.add_table(rows=2, cols=2)
-    table.style = 'Light List'
-    table.cell(0, 0).text = 'Panel Coverage'
-    table.cell(0, 1).text = '% of bases ≥ 20x'
-    table.cell(1, 0).text = str(panel_name)
-    table.cell(1, 1).text = f"{coverage_pct:.2f}%" if isinstance(coverage_pct, (int, float)) else str(coverage_pct)
-
-    doc.add_paragraph()
-
-    # Add sorted gene list (all italic)
-    p = doc.add_paragraph()
-    for idx, (gene_name, italic) in enumerate(gene_lists[file]):
-        run = p.add_run(gene_name)
-        run.italic = True  # Always italic
-        if idx < len(gene_lists[file]) - 1:
-            p.add_run(', ')
-    doc.add_paragraph()
-
-# Add explanatory note at the end
-doc.add_paragraph(
+FOOTNOTE = (
     "* This gene has suboptimal coverage, defined as less than 95% of its target nucleotides "
     "covered at >20x with a mapping quality score of twenty (MQ≥20). This may be due to "
     "inherent sequencing chemistry limitations or regions of the gene containing duplicated "
     "sequences within the genome."
 )
 
-# Save Word output
-word_out = os.path.join(root_dir, 'gene_coverage_summary.docx')
-doc.save(word_out)
-print(f"Saved gene coverage Word document: {word_out}")
 
+def create_parser():
+    # Argument parser to get the root directory from user input
+    parser = argparse.ArgumentParser(description='Process coverage QC Excel files.')
+    parser.add_argument(
+        '-d', '--directory',
+        required=True,
+        help='Root directory containing the Excel files'
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of processes reading the Excel files at the same time (default: the number of CPUs)'
+    )
+    parser.add_argument(
+        '--include',
+        type=lambda t: t.split(','),
+        default=['*.xlsx'],
+        help='Comma separated globs of the file names to summarise (default: *.xlsx)'
+    )
+    parser.add_argument(
+        '--exclude',
+        type=lambda t: t.split(','),
+        default=['~$*'],
+        help='Comma separated globs of the file names to skip (default: ~$*, the Excel lock files)'
+    )
+    parser.add_argument(
+        '--prune',
+        type=lambda t: t.split(','),
+        default=PRUNE_DIRS,
+        help=f'Comma separated globs of the directory names that are not searched (default: {",".join(PRUNE_DIRS)})'
+    )
+    parser.add_argument(
+        '--max_depth',
+        type=int,
+        default=None,
+        help='Only search this many directory levels below the root directory (default: no limit)'
+    )
+    parser.add_argument(
+        '--index',
+        action='store_true',
+        help=f'Keep the directory listings in <directory>/{LISTING_INDEX_NAME} and only list the directories that changed since the last run'
+    )
+    parser.add_argument(
+        '--renderer',
+        choices=['xml', 'python-docx'],
+        default='xml',
+        help='Write the document body XML directly (xml, the default) or build it with python-docx'
+    )
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help=f'Read every Excel file again instead of reusing the results cached in <directory>/{SUMMARY_CACHE_NAME}'
+    )
+    parser.add_argument(
+        '--timings',
+        action='store_true',
+        help='Write the wall time, CPU time and peak memory of every step to gene_coverage_summary.timings.json'
+    )
+    parser.add_argument(
+        '--cprofile',
+        default=None,
+        help='Run the script under cProfile and save the profile to this path'
+    )
+    return parser
+
+
+def matches(name, patterns):
+    return any(fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def load_listing_index(index_path, settings):
+    """
+    Returns the directory listings (relative path -> (mtime_ns, files, subdirs)) of a previous discovery with the
+    same settings, or an empty index when there is none or it can't be read.
+    """
+    try:
+        with open(index_path, 'rb') as fh:
+            index = pickle.load(fh)
+        if index.get('version') == LISTING_INDEX_VERSION and index.get('settings') == settings:
+            return index['dirs']
+    except Exception:
+        pass
+    return {}
+
+
+def save_listing_index(index_path, settings, dirs):
+    """
+    Saves the directory listings, writing a temporary file first so the index is never half written.
+    """
+    try:
+        with open(index_path + '.tmp%i' % os.getpid(), 'wb') as fh:
+            pickle.dump({'version': LISTING_INDEX_VERSION, 'settings': settings, 'dirs': dirs}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(index_path + '.tmp%i' % os.getpid(), index_path)
+    except OSError as e:
+        print(f"Could not write the listing index {index_path}: {e}")
+
+
+def find_workbooks(root_dir, include=('*.xlsx',), exclude=('~$*',), prune=PRUNE_DIRS, max_depth=None, index_path=None):
+    """
+    Returns the path of every file under root_dir whose name matches an include glob and no exclude glob, in
+    os.walk order, and the number of directories that were listed. Directories whose name matches a prune glob
+    aren't entered, nor are directories deeper than max_depth (0 is just root_dir) or symbolic links to directories.
+
+    With an index_path, the matching files and subdirectories of every directory are kept in an index. A later
+    run only stats a directory whose modification time is unchanged instead of listing it again, so the scan only
+    lists the directories where files were added, removed or renamed.
+    """
+    settings = (tuple(include), tuple(exclude), tuple(prune), max_depth)
+    index = load_listing_index(index_path, settings) if index_path else {}
+    # A directory changed in the same clock tick as its listing may change again without a new modification
+    # time, so such listings are listed again on the next run
+    racy_after = time.time_ns() - RACY_LISTING_NS
+    dirs = {}
+    workbooks = []
+    listed = 0
+    stack = [('', 0)]
+    while stack:
+        rel_dir, depth = stack.pop()
+        subdir = os.path.join(root_dir, rel_dir) if rel_dir else root_dir
+        try:
+            mtime_ns = os.stat(subdir).st_mtime_ns
+        except OSError:
+            continue
+        listing = index.get(rel_dir)
+        if listing is None or listing[0] != mtime_ns:
+            files, subdirs = [], []
+            try:
+                with os.scandir(subdir) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if not is_dir:
+                            if matches(entry.name, include) and not matches(entry.name, exclude):
+                                files.append(entry.name)
+                        elif not entry.is_symlink() and not matches(entry.name, prune):
+                            subdirs.append(entry.name)
+            except OSError:
+                continue
+            listing = (mtime_ns, files, subdirs)
+            listed += 1
+        if mtime_ns < racy_after:
+            dirs[rel_dir] = listing
+
+        workbooks.extend(os.path.join(subdir, file) for file in listing[1])
+        if max_depth is None or depth < max_depth:
+            stack.extend((os.path.join(rel_dir, name), depth + 1) for name in reversed(listing[2]))
+
+    if index_path:
+        save_listing_index(index_path, settings, dirs)
+    return workbooks, listed
+
+
+def format_genes(genes, coverages):
+    """
+    Returns the sorted [(gene_name, italic), ...] list of a Gene Coverage sheet, marking genes with less than
+    95% of their bases at 20x or more with a '*'.
+    """
+    genes_with_format = []
+    for gene, cov in zip(genes, coverages):
+        if pd.isna(gene):
+            continue
+        try:
+            cov_val = float(cov)
+        except (ValueError, TypeError):
+            cov_val = 100
+
+        gene_str = str(gene)
+        if cov_val < 0.95:
+            genes_with_format.append((gene_str + '*', True))  # Low coverage
+        else:
+            genes_with_format.append((gene_str, True))  # Italic regardless
+
+    # Sort genes alphabetically
+    return sorted(genes_with_format, key=lambda x: x[0].lower())
+
+
+def read_workbook(file_path):
+    """
+    Reads a coverage workbook in openpyxl's read-only mode, streaming the cell values of just the rows needed:
+    the first data row of Panel Coverage and columns A and E of Gene Coverage. Memory stays constant however
+    many genes the workbook has. Returns the (panel_name, %>=20x) of the Panel Coverage sheet and the sorted
+    [(gene_name, italic), ...] of the Gene Coverage sheet. The gene list is None when the Panel Coverage sheet
+    can't be read, so the file is left out of the document.
+    """
+    try:
+        workbook = load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    except Exception as e:
+        print(f"Error reading Panel Coverage in {file_path}: {e}")
+        return ("N/A", "N/A"), None
+
+    try:
+        # Read from Panel Coverage sheet: %>=20x (E2) and Panel Name (B2), below the header row
+        try:
+            rows = workbook['Panel Coverage'].iter_rows(min_row=1, max_row=2, values_only=True)
+            next(rows)  # Header
+            row = next(rows) + (None,) * 5
+            panel_name = nan if row[1] is None else row[1]
+            value = nan if row[4] is None else row[4]
+
+            if isinstance(value, str) and '%' in value:
+                value = value.replace('%', '').strip()
+            value = float(value) * 100  # Convert to percentage
+
+            panel = (panel_name, value)
+
+        except Exception as e:
+            print(f"Error reading Panel Coverage in {file_path}: {e}")
+            return ("N/A", "N/A"), None
+
+        # Read columns A (gene) and E (%>=20x) of the Gene Coverage sheet
+        try:
+            rows = workbook['Gene Coverage'].iter_rows(values_only=True)
+            header = next(rows, ())
+            if len(header) < 5:
+                raise IndexError("the Gene Coverage sheet has less than 5 columns")
+            genes, coverages = [], []
+            for row in rows:
+                if len(row) < 5:
+                    row = row + (None,) * (5 - len(row))
+                genes.append(row[0])
+                coverages.append(row[4])
+            return panel, format_genes(genes, coverages)
+
+        except Exception as e:
+            print(f"Error reading Gene Coverage in {file_path}: {e}")
+            return panel, []
+    finally:
+        workbook.close()
+
+
+def load_summary_cache(cache_path):
+    """
+    Returns the cached read_workbook results (path -> {'size', 'mtime_ns', 'result'}) of a previous run, or an
+    empty cache when there is none or it can't be read.
+    """
+    try:
+        with open(cache_path, 'rb') as fh:
+            cache = pickle.load(fh)
+        if cache.get('version') == SUMMARY_CACHE_VERSION:
+            return cache['entries']
+    except Exception:
+        pass
+    return {}
+
+
+def save_summary_cache(cache_path, entries):
+    """
+    Saves the read_workbook results to the cache, writing a temporary file first so it's never half written.
+    """
+    try:
+        with open(cache_path + '.tmp%i' % os.getpid(), 'wb') as fh:
+            pickle.dump({'version': SUMMARY_CACHE_VERSION, 'entries': entries}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_path + '.tmp%i' % os.getpid(), cache_path)
+    except OSError as e:
+        print(f"Could not write the summary cache {cache_path}: {e}")
+
+
+def read_workbooks(workbooks, workers=1, cache_path=None):
+    """
+    Reads every workbook on a pool of worker processes. Returns panel_info (file -> (panel_name, %>=20x)) and
+    gene_lists (file -> [(gene_name, italic), ...]), keyed by file name, and the number of workbooks read. The
+    results are collected in the order of workbooks, so when two folders hold a file with the same name the later
+    one wins, as in a serial walk.
+
+    With a cache_path, workbooks whose path, size and modification time are in the cache aren't read again, and
+    the cache is rewritten with just the current workbooks, dropping the ones that were deleted.
+    """
+    panel_info = {}    # Holds (panel_name, %>=20x)
+    gene_lists = {}    # Holds [(gene_name, italic), ...]
+    cached = load_summary_cache(cache_path) if cache_path else {}
+    entries = {}
+    to_read = []
+    for file_path in workbooks:
+        st = os.stat(file_path)
+        key = os.path.abspath(file_path)
+        entry = cached.get(key)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            entries[key] = entry
+        else:
+            entries[key] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'result': None}
+            to_read.append(file_path)
+
+    if workers > 1 and len(to_read) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(to_read))) as pool:
+            results = list(pool.map(read_workbook, to_read, chunksize=max(1, len(to_read) // (workers * 4))))
+    else:
+        results = [read_workbook(file_path) for file_path in to_read]
+    for file_path, result in zip(to_read, results):
+        entries[os.path.abspath(file_path)]['result'] = result
+
+    for file_path in workbooks:
+        panel, genes = entries[os.path.abspath(file_path)]['result']
+        file = os.path.basename(file_path)
+        panel_info[file] = panel
+        if genes is not None:
+            gene_lists[file] = genes
+
+    if cache_path:
+        save_summary_cache(cache_path, entries)
+    return panel_info, gene_lists, len(to_read)
+
+
+def render_summary(panel_info, gene_lists):
+    """
+    Creates the Word document with a summary table and the sorted gene list of every file.
+    """
+    # Create Word document with table and sorted gene list
+    doc = Document()
+    doc.add_heading('Gene Coverage Summary', 0)
+
+    for file in sorted(gene_lists.keys()):
+        panel_name, coverage_pct = panel_info.get(file, ("N/A", "N/A"))
+
+        doc.add_heading(f"File: {file}", level=1)
+
+        # Add summary table
+        table = doc.add_table(rows=2, cols=2)
+        table.style = 'Light List'
+        table.cell(0, 0).text = 'Panel Coverage'
+        table.cell(0, 1).text = '% of bases ≥ 20x'
+        table.cell(1, 0).text = str(panel_name)
+        table.cell(1, 1).text = f"{coverage_pct:.2f}%" if isinstance(coverage_pct, (int, float)) else str(coverage_pct)
+
+        doc.add_paragraph()
+
+        # Add sorted gene list (all italic)
+        p = doc.add_paragraph()
+        for idx, (gene_name, italic) in enumerate(gene_lists[file]):
+            run = p.add_run(gene_name)
+            run.italic = True  # Always italic
+            if idx < len(gene_lists[file]) - 1:
+                p.add_run(', ')
+        doc.add_paragraph()
+
+    # Add explanatory note at the end
+    doc.add_paragraph(FOOTNOTE)
+    return doc
+
+
+# The streaming renderer writes the same WordprocessingML that python-docx writes for render_summary, straight
+# from the extracted data into the document part of python-docx's default template. The styles (Title, Heading 1,
+# Light List) come from the template, so the result looks the same without building python-docx's object tree.
+TABLE_XML = (
+    '<w:tbl><w:tblPr><w:tblStyle w:val="LightList"/><w:tblW w:type="auto" w:w="0"/><w:tblLook w:firstColumn="1" '
+    'w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>'
+    '<w:tblGrid><w:gridCol w:w="{width}"/><w:gridCol w:w="{width}"/></w:tblGrid>{rows}</w:tbl>'
+)
+CELL_XML = '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr><w:p>{run}</w:p></w:tc>'
+ITALIC_XML = '<w:rPr><w:i/></w:rPr>'
+
+
+def run_xml(text, italic=False):
+    """
+    Returns the <w:r> of a run of text as python-docx writes it: tabs and line breaks become <w:tab/> and <w:br/>,
+    and text with leading or trailing spaces keeps them with xml:space="preserve".
+    """
+    content = []
+    for i, part in enumerate(re.split(r'([\t\n\r])', text)):
+        if i % 2:
+            content.append('<w:tab/>' if part == '\t' else '<w:br/>')
+        elif part:
+            space = ' xml:space="preserve"' if part != part.strip() else ''
+            content.append(f'<w:t{space}>{escape(part)}</w:t>')
+    properties = ITALIC_XML if italic else ''
+    return f'<w:r>{properties}{"".join(content)}</w:r>' if properties or content else '<w:r/>'
+
+
+def paragraph_xml(runs='', style=None):
+    properties = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ''
+    return f'<w:p>{properties}{runs}</w:p>' if properties or runs else '<w:p/>'
+
+
+def file_section_xml(file, panel_name, coverage_pct, genes, cell_width):
+    """
+    Returns the heading, summary table and gene list of one file.
+    """
+    cells = [['Panel Coverage', '% of bases ≥ 20x'],
+             [str(panel_name), f"{coverage_pct:.2f}%" if isinstance(coverage_pct, (int, float)) else str(coverage_pct)]]
+    rows = ''.join('<w:tr>' + ''.join(CELL_XML.format(width=cell_width, run=run_xml(text)) for text in row) + '</w:tr>' for row in cells)
+    separator = run_xml(', ')
+    gene_runs = separator.join(run_xml(gene_name, italic=True) for gene_name, italic in genes)  # All italic
+    return (paragraph_xml(run_xml(f"File: {file}"), 'Heading1') + TABLE_XML.format(width=cell_width, rows=rows)
+            + paragraph_xml() + paragraph_xml(gene_runs) + paragraph_xml())
+
+
+def write_summary_xml(word_out, panel_info, gene_lists):
+    """
+    Writes the same document as render_summary to word_out, streaming the document body one file at a time.
+    """
+    template = Document()
+    section = template.sections[0]
+    cell_width = Emu((section.page_width - section.left_margin - section.right_margin) // 2).twips
+    template_file = BytesIO()
+    template.save(template_file)
+
+    with zipfile.ZipFile(template_file) as template_zip, zipfile.ZipFile(word_out, 'w', zipfile.ZIP_DEFLATED) as out_zip:
+        for item in template_zip.infolist():
+            if item.filename != 'word/document.xml':
+                out_zip.writestr(item, template_zip.read(item))
+                continue
+            document = template_zip.read(item).decode('utf-8')
+            body_start = document.index('<w:body>') + len('<w:body>')
+            body_end = document.index('<w:sectPr')
+            with out_zip.open(item, 'w') as fh:
+                fh.write(document[:body_start].encode('utf-8'))
+                fh.write(paragraph_xml(run_xml('Gene Coverage Summary'), 'Title').encode('utf-8'))
+                for file in sorted(gene_lists.keys()):
+                    panel_name, coverage_pct = panel_info.get(file, ("N/A", "N/A"))
+                    fh.write(file_section_xml(file, panel_name, coverage_pct, gene_lists[file], cell_width).encode('utf-8'))
+                fh.write(paragraph_xml(run_xml(FOOTNOTE)).encode('utf-8'))
+                fh.write(document[body_end:].encode('utf-8'))
+
+
+def write_summary(word_out, panel_info, gene_lists, renderer='xml'):
+    """
+    Writes the Word summary with the streaming XML renderer, or with python-docx (render_summary).
+    """
+    if renderer == 'python-docx':
+        render_summary(panel_info, gene_lists).save(word_out)
+    else:
+        write_summary_xml(word_out, panel_info, gene_lists)
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    root_dir = args.directory
+
+    recorder = StageRecorder()
+    if args.cprofile:
+        recorder.start_profile()
+
+    with recorder.stage('discover') as stage:
+        index_path = os.path.join(root_dir, LISTING_INDEX_NAME) if args.index else None
+        workbooks, listed = find_workbooks(root_dir, args.include, args.exclude, args.prune, args.max_depth, index_path)
+        stage['rows'] = len(workbooks)
+    print(f"Found {len(workbooks)} Excel files in {recorder.stages['discover']['wall_seconds']:.2f} seconds, listing {listed} directories")
+
+    with recorder.stage('read_workbooks') as stage:
+        cache_path = None if args.no_cache else os.path.join(root_dir, SUMMARY_CACHE_NAME)
+        panel_info, gene_lists, stage['rows'] = read_workbooks(workbooks, args.workers, cache_path)
+    print(f"Read {stage['rows']} of {len(workbooks)} Excel files, {len(workbooks) - stage['rows']} were unchanged since the last run")
+
+    # Save Word output
+    word_out = os.path.join(root_dir, 'gene_coverage_summary.docx')
+    with recorder.stage('render_docx', rows=sum(len(genes) for genes in gene_lists.values())):
+        write_summary(word_out, panel_info, gene_lists, args.renderer)
+    print(f"Saved gene coverage Word document: {word_out}")
+
+    if args.cprofile:
+        recorder.dump_profile(args.cprofile)
+    if args.timings:
+        recorder.write(os.path.join(root_dir, 'gene_coverage_summary.timings.json'))
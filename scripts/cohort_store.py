@@ -0,0 +1,254 @@
+from argparse import ArgumentParser
+from datetime import datetime
+from glob import glob
+from os.path import basename, join
+from re import match
+from sqlite3 import connect as sqlite_connect
+from sys import stdout
+import numpy as np
+from pandas import DataFrame, Index, read_excel
+
+# The cohort store is a SQLite database with one row per (sample, panel) in panel_coverage, holding the AVG Coverage
+# and %Bases columns of the "Panel Coverage" sheet (avg_coverage, pct_0x, pct_10x, ...), and one row per (sample,
+# panel) in gene_coverage holding the genes of the "Gene Coverage" sheet and every metric column as a float64 array
+# of the same order. Gene x sample queries over thousands of samples then read a few thousand rows instead of
+# millions. Columns for new thresholds are added when a report first uses them. The database runs in WAL mode,
+# so every worker of a batch can append to it while others query it.
+BUSY_TIMEOUT_SECONDS = 120
+REPORT_SUFFIX = ".qc_coverage_by_level.xlsx"
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS panel_coverage (
+           sample TEXT NOT NULL, panel TEXT NOT NULL, report TEXT NOT NULL, run TEXT, added TEXT,
+           avg_coverage REAL, PRIMARY KEY (sample, panel))""",
+    """CREATE TABLE IF NOT EXISTS gene_coverage (
+           sample TEXT NOT NULL, panel TEXT NOT NULL, genes TEXT NOT NULL,
+           avg_coverage BLOB, PRIMARY KEY (sample, panel))""",
+    "CREATE INDEX IF NOT EXISTS panel_coverage_report ON panel_coverage (report)",
+]
+
+
+def connect(db_path):
+    """
+    Opens (and creates) the cohort store at db_path in WAL mode. Writers wait up to BUSY_TIMEOUT_SECONDS for
+    each other instead of failing.
+    """
+    con = sqlite_connect(db_path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    for statement in SCHEMA:
+        con.execute(statement)
+    return con
+
+
+def metric_column(column):
+    """
+    Returns the cohort store column of a workbook metric column, e.g. "%Bases > 20X" -> "pct_20x".
+    """
+    if column == "AVG Coverage":
+        return "avg_coverage"
+    threshold = match(r"%Bases > (\d+)X$", column)
+    if threshold is None:
+        raise ValueError(f"{column} is not a coverage metric column")
+    return "pct_%sx" % (threshold.group(1))
+
+
+def _columns(con, table):
+    return [row[1] for row in con.execute(f"PRAGMA table_info({table})")]
+
+
+def _add_missing_columns(con, table, columns, column_type):
+    existing = set(_columns(con, table))
+    for column in columns:
+        if column not in existing:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def add_report(db_path, report, panel_samples, gene_coverage, panel_coverage, run=""):
+    """
+    Adds (or replaces) the gene and panel metrics of the coverage workbook of report. gene_coverage and
+    panel_coverage are the "Gene Coverage" and "Panel Coverage" sheets of the workbook, and panel_samples holds
+    the sample name of every row of the panel sheet. Everything is written in one transaction.
+    """
+    metric_cols = [col for col in panel_coverage.columns if col != "Panel"]
+    db_cols = [metric_column(col) for col in metric_cols]
+    added = datetime.now().isoformat(timespec="seconds")
+    con = connect(db_path)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        _add_missing_columns(con, "panel_coverage", db_cols, "REAL")
+        _add_missing_columns(con, "gene_coverage", db_cols, "BLOB")
+        for sample, (i, panel_row) in zip(panel_samples, panel_coverage.iterrows()):
+            panel = str(panel_row["Panel"])
+            genes = gene_coverage[gene_coverage["Panel"].astype(str) == panel]
+            con.execute(f"INSERT OR REPLACE INTO panel_coverage (sample, panel, report, run, added, {', '.join(db_cols)}) "
+                        f"VALUES (?, ?, ?, ?, ?{', ?' * len(db_cols)})",
+                        [sample, panel, report, run, added] + [_value(panel_row[col]) for col in metric_cols])
+            con.execute(f"INSERT OR REPLACE INTO gene_coverage (sample, panel, genes, {', '.join(db_cols)}) "
+                        f"VALUES (?, ?, ?{', ?' * len(db_cols)})",
+                        [sample, panel, "\t".join(genes["gene"].astype(str))]
+                        + [genes[col].to_numpy(dtype="<f8", na_value=np.nan).tobytes() for col in metric_cols])
+        con.execute("COMMIT")
+    except BaseException:
+        if con.in_transaction: con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+
+
+def _value(value):
+    return None if value is None or value != value else float(value)  # NaN is stored as NULL
+
+
+def has_report(db_path, report):
+    """
+    Returns True when the cohort store already holds the metrics of the coverage workbook of report.
+    """
+    con = connect(db_path)
+    try:
+        return con.execute("SELECT 1 FROM panel_coverage WHERE report = ? LIMIT 1", (report,)).fetchone() is not None
+    finally:
+        con.close()
+
+
+def add_workbook(db_path, workbook, run=""):
+    """
+    Adds an existing <report>.qc_coverage_by_level.xlsx workbook to the cohort store. Returns the report name.
+    """
+    from CovReportConglomeration import getPanelSampleNames
+    report = basename(workbook)[:-len(REPORT_SUFFIX)]
+    sheets = read_excel(workbook, sheet_name=["Gene Coverage", "Panel Coverage"], dtype={"gene": str, "Panel": str})
+    add_report(db_path, report, getPanelSampleNames(report), sheets["Gene Coverage"], sheets["Panel Coverage"], run)
+    return report
+
+
+def _where(filters):
+    clauses, params = [], []
+    for column, values in filters:
+        if values:
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def _metric_values(db_path, metric, panels=None, genes=None, samples=None):
+    """
+    Returns the gene codes, the gene names, the sample codes, the sample names and the values of a metric for
+    every (sample, panel, gene) of the cohort store that passes the filters.
+    """
+    con = connect(db_path)
+    try:
+        columns = _columns(con, "gene_coverage")
+        if metric not in columns[3:]:
+            raise ValueError(f"The cohort store has no {metric} column, choose one of: {', '.join(columns[3:])}")
+        where, params = _where([("panel", panels), ("sample", samples)])
+        rows = con.execute(f"SELECT sample, genes, {metric} FROM gene_coverage{where} ORDER BY sample, panel", params).fetchall()
+    finally:
+        con.close()
+
+    # The rows of a panel mostly share the same gene list, so every distinct gene list is only coded once
+    gene_lists = {row_gene_names: row_gene_names.split("\t") if row_gene_names else [] for sample, row_gene_names, blob in rows}
+    gene_names = np.array(sorted(set(gene for names in gene_lists.values() for gene in names)), dtype=object)
+    gene_index = {gene: i for i, gene in enumerate(gene_names)}
+    gene_list_codes = {row_gene_names: np.array([gene_index[gene] for gene in names], dtype=np.int64) for row_gene_names, names in gene_lists.items()}
+    sample_names = np.array(sorted(set(row[0] for row in rows)), dtype=object)
+    sample_index = {sample: i for i, sample in enumerate(sample_names)}
+
+    lengths = [len(gene_list_codes[row_gene_names]) for sample, row_gene_names, blob in rows]
+    gene_codes = np.concatenate([gene_list_codes[row_gene_names] for sample, row_gene_names, blob in rows] or [np.zeros(0, dtype=np.int64)])
+    sample_codes = np.repeat(np.array([sample_index[row[0]] for row in rows], dtype=np.int64), lengths)
+    values = np.concatenate([np.frombuffer(blob, dtype="<f8") if blob else np.full(length, np.nan)
+                             for length, (sample, row_gene_names, blob) in zip(lengths, rows)] or [np.zeros(0)])
+    if genes:
+        keep = np.isin(gene_codes, np.flatnonzero(np.isin(gene_names, list(genes))))
+        gene_codes, sample_codes, values = gene_codes[keep], sample_codes[keep], values[keep]
+    return gene_codes, gene_names, sample_codes, sample_names, values
+
+
+def gene_matrix(db_path, metric="pct_20x", panels=None, genes=None, samples=None):
+    """
+    Returns the gene x sample matrix of a metric (avg_coverage or pct_<threshold>x), optionally restricted to some
+    panels, genes and samples. A sample tested on two panels that share a gene gets the mean of both.
+    """
+    gene_codes, gene_names, sample_codes, sample_names, values = _metric_values(db_path, metric, panels, genes, samples)
+    known = ~np.isnan(values)
+    sums = np.zeros((len(gene_names), len(sample_names)))
+    counts = np.zeros((len(gene_names), len(sample_names)))
+    np.add.at(sums, (gene_codes[known], sample_codes[known]), values[known])
+    np.add.at(counts, (gene_codes[known], sample_codes[known]), 1)
+    with np.errstate(invalid="ignore"):
+        matrix = DataFrame(sums / counts, index=Index(gene_names, name="gene"), columns=Index(sample_names, name="sample"))
+    return matrix.loc[matrix.notna().any(axis=1)] if genes else matrix
+
+
+def gene_percentiles(db_path, metric="pct_20x", percentiles=(5, 25, 50, 75, 95), panels=None, genes=None, samples=None):
+    """
+    Returns the number of samples and the percentiles of a metric for every gene across the cohort.
+    """
+    gene_codes, gene_names, sample_codes, sample_names, values = _metric_values(db_path, metric, panels, genes, samples)
+    known = ~np.isnan(values)
+    gene_codes, values = gene_codes[known], values[known]
+    order = np.lexsort((values, gene_codes))
+    gene_codes, values = gene_codes[order], values[order]
+    present, starts, counts = np.unique(gene_codes, return_index=True, return_counts=True)
+    result = DataFrame({"samples": counts}, index=Index(np.asarray(gene_names)[present], name="gene"))
+    for p in percentiles:
+        # Linear interpolation between the sorted values of each gene, as numpy.percentile does
+        position = starts + (counts - 1) * p / 100.0
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, starts + counts - 1)
+        result["p%s" % (p)] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    return result
+
+
+def create_parser():
+    parser = ArgumentParser(description="Add coverage workbooks to the cohort store and query gene x sample coverage across runs.")
+    parser.add_argument("-d", "--db", type=str, required=True,
+                        help="The cohort store (SQLite database).")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="Add existing coverage workbooks (<sample>.qc_coverage_by_level.xlsx) to the cohort store.")
+    add.add_argument("folders", nargs="+",
+                     help="Folders that are searched (recursively) for coverage workbooks.")
+    add.add_argument("--run_name", type=str, default="",
+                     help="The run name stored with the added samples.")
+
+    for name, description in (("matrix", "Write the gene x sample matrix of a metric."),
+                              ("percentiles", "Write the percentiles of a metric for every gene.")):
+        query = commands.add_parser(name, help=description)
+        query.add_argument("-m", "--metric", type=str, default="pct_20x",
+                           help="The metric: avg_coverage or pct_<threshold>x (default: pct_20x).")
+        query.add_argument("-p", "--panels", type=lambda t: t.split(','), default=None,
+                           help="Comma separated panels (CGLs) to include (default: all).")
+        query.add_argument("-g", "--genes", type=lambda t: t.split(','), default=None,
+                           help="Comma separated genes to include (default: all).")
+        query.add_argument("-s", "--samples", type=lambda t: t.split(','), default=None,
+                           help="Comma separated samples to include (default: all).")
+        query.add_argument("-o", "--output", type=str, default=None,
+                           help="The output TSV file (default: standard output).")
+        if name == "percentiles":
+            query.add_argument("--percentiles", type=lambda t: [float(x) for x in t.split(',')], default=[5, 25, 50, 75, 95],
+                               help="Comma separated percentiles (default: 5,25,50,75,95).")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.command == "add":
+        workbooks = sorted(set(workbook for folder in args.folders for workbook in glob(join(folder, "**", "*" + REPORT_SUFFIX), recursive=True)))
+        for workbook in workbooks:
+            try:
+                print("Added", add_workbook(args.db, workbook, args.run_name))
+            except Exception as e:
+                print(f"Error adding {workbook} to the cohort store: {e}")
+    else:
+        try:
+            if args.command == "matrix":
+                result = gene_matrix(args.db, args.metric, args.panels, args.genes, args.samples)
+            else:
+                result = gene_percentiles(args.db, args.metric, [p if p % 1 else int(p) for p in args.percentiles], args.panels, args.genes, args.samples)
+        except ValueError as e:
+            parser.error(str(e))
+        result.to_csv(args.output or stdout, sep="\t", float_format="%.4g")
@@ -0,0 +1,289 @@
+from argparse import ArgumentParser
+from json import dump, load
+from os import makedirs, remove
+from os.path import abspath, dirname, exists, join
+from platform import node, python_version
+from subprocess import DEVNULL, run
+from sys import executable, exit
+from time import perf_counter
+from zipfile import ZipFile
+from multiprocessing import get_context
+import resource
+import numpy as np
+from pandas import DataFrame, concat
+from coverage_cache import coverage_cache_paths
+from coverage_reader import tabix_index_path
+from CovReportConglomeration import (coverageMetrics, getPanelBed, getPanelSampleNames, loadCoverageIndex, metricColumns,
+                                     exonCoverageStats, parseSampleSheet, writeCoverageWorkbook)
+from Gene_coverage_report1 import render_summary, write_summary_xml
+from instrumentation import StageRecorder, peak_rss_mb
+
+# Benchmark of the coverage report path on synthetic data. "generate" writes a run folder with full resolution BED
+# files, CGL panel beds and a V2 sample sheet, "run" times every stage of the report and compares it to a baseline.
+# "docx" compares the two renderers of the Word summary on synthetic gene lists.
+SCRIPT_DIR = dirname(abspath(__file__))
+CHROMS = ["chr%s" % (c) for c in list(range(1, 23)) + ["X", "Y"]]
+FULL_RES_SUFFIX = ".qc-coverage-region-1_full_res.bed"
+
+
+def create_parser():
+    parser = ArgumentParser(description="Generate synthetic coverage data and benchmark the coverage report scripts on it.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate = subparsers.add_parser("generate", help="Write a synthetic run folder.")
+    generate.add_argument("-o", "--out_dir", type=str, required=True, help="The folder the synthetic run is written to.")
+    generate.add_argument("--intervals", type=int, default=1000000, help="Intervals per full resolution BED file (default: 1000000).")
+    generate.add_argument("--samples", type=int, default=2, help="Number of single panel samples (default: 2).")
+    generate.add_argument("--multi_samples", type=int, default=1, help="Number of two panel multi-samples (default: 1).")
+    generate.add_argument("--panels", type=int, default=3, help="Number of CGL panel beds (default: 3).")
+    generate.add_argument("--exons", type=int, default=5000, help="Exons per panel bed (default: 5000).")
+    generate.add_argument("--seed", type=int, default=1, help="Random seed (default: 1).")
+
+    bench = subparsers.add_parser("run", help="Time every stage of the coverage report on a synthetic run folder.")
+    bench.add_argument("-d", "--data_dir", type=str, required=True, help="A folder written by the generate command.")
+    bench.add_argument("-o", "--output", type=str, default="coverage_benchmark.json", help="The JSON results file (default: coverage_benchmark.json).")
+    bench.add_argument("--baseline", type=str, default=None, help="A previous results file to compare against.")
+    bench.add_argument("--tolerance", type=float, default=0.25,
+                       help="Allowed fractional slow down of a stage compared to the baseline before the run fails (default: 0.25).")
+
+    docx = subparsers.add_parser("docx", help="Compare the python-docx and streaming XML renderers of the Word summary.")
+    docx.add_argument("-o", "--out_dir", type=str, required=True, help="The folder the two Word documents are written to.")
+    docx.add_argument("--files", type=int, default=20, help="Number of workbooks in the summary (default: 20).")
+    docx.add_argument("--genes", type=int, default=1000, help="Genes per workbook (default: 1000).")
+    docx.add_argument("--repeats", type=int, default=3, help="Timed runs of every renderer, the fastest is reported (default: 3).")
+    docx.add_argument("--seed", type=int, default=1, help="Random seed (default: 1).")
+    return parser
+
+
+#################### Synthetic data ####################
+def writeFullRes(path, intervals, rng):
+    '''
+    writeFullRes tiles every chromosome with non-overlapping intervals the way the full resolution report does:
+    short intervals with a depth around 100X over targets, separated by long intervals with little or no coverage.
+    '''
+    perChrom = np.full(len(CHROMS), intervals // len(CHROMS))
+    perChrom[:intervals % len(CHROMS)] += 1
+    targets = {}
+    with open(path, "w") as fh:
+        for chrom, n in zip(CHROMS, perChrom):
+            onTarget = rng.random(n) < 0.8
+            lengths = np.where(onTarget, rng.integers(1, 40, n), rng.integers(500, 20000, n))
+            coverage = np.where(onTarget, rng.gamma(6.0, 18.0, n).astype(int), rng.integers(0, 3, n))
+            ends = np.cumsum(lengths)
+            starts = ends - lengths
+            DataFrame({"chrom": chrom, "start": starts, "end": ends, "coverage": coverage}).to_csv(fh, sep="\t", header=False, index=False)
+            targets[chrom] = (starts[onTarget], ends[onTarget])
+    return targets
+
+
+def writePanelBed(path, targets, exons, rng):
+    rows = []
+    for i in range(exons):
+        chrom = CHROMS[rng.integers(0, len(CHROMS))]
+        starts, ends = targets[chrom]
+        if len(starts) == 0: continue
+        first = rng.integers(0, len(starts))
+        last = min(len(starts) - 1, first + rng.integers(2, 12))
+        rows.append((chrom, int(starts[first]), int(ends[last]), "ex%i" % (i), "GENE%i" % (i // 8)))
+    DataFrame(rows).to_csv(path, sep="\t", header=False, index=False)
+
+
+def generate(args):
+    rng = np.random.default_rng(args.seed)
+    makedirs(join(args.out_dir, "beds"), exist_ok=True)
+    sampleRows = []
+    for i in range(args.samples):
+        sampleRows.append(("NGS26-%04i" % (1000 + i), "CGL%i" % (i % args.panels + 1)))
+    for i in range(args.multi_samples):
+        first, second = 2000 + 2 * i, 2001 + 2 * i
+        sampleRows.append(("NGS26-%04i_%04i-%i" % (first, second, i + 1), "CGL%i_%i" % (i % args.panels + 1, (i + 1) % args.panels + 1)))
+
+    targets = None
+    for sampleName, panels in sampleRows:
+        print("Writing", sampleName)
+        makedirs(join(args.out_dir, "run", sampleName), exist_ok=True)
+        sampleTargets = writeFullRes(join(args.out_dir, "run", sampleName, sampleName + FULL_RES_SUFFIX), args.intervals, rng)
+        targets = targets or sampleTargets
+    for p in range(1, args.panels + 1):
+        writePanelBed(join(args.out_dir, "beds", "CGL%i.bed" % (p)), targets, args.exons, rng)
+
+    with open(join(args.out_dir, "SampleSheet.csv"), "w") as fh:
+        fh.write("[Header],,\nFileFormatVersion,2,\n,,\n[Cloud_Data],,\nSample_ID,ProjectName,Description,\n")
+        for sampleName, panels in sampleRows + [("PC-0001", "CGL1")]:
+            fh.write("%s,Benchmark,%s,\n" % (sampleName, panels))
+        fh.write(",,\n")
+    print("Synthetic run written to", args.out_dir)
+
+
+#################### Benchmark ####################
+def coverageRows(covIndex):
+    return sum(len(starts) for starts, ends, coverage in covIndex.values())
+
+
+def benchmarkSample(recorder, fullResCov, sampleName, sampleSheetDF, bedFolder, outDir, thresholds=(0, 10, 20, 50, 100)):
+    '''
+    benchmarkSample runs the report of one sample through the functions of CovReportConglomeration.py, recording every
+    stage. The full resolution coverage is loaded the ways the script loads it: streamed without the cache, parsed once
+    into a new sidecar cache, memory-mapped from that cache and, when the run folder has a bgzipped, tabix indexed copy
+    (<full_res>.gz and <full_res>.gz.tbi), fetched region by region.
+    '''
+    panels = [getPanelBed(sampleSheetDF, samp, bedFolder, sampleName, useCache=False) for samp in getPanelSampleNames(sampleName)]
+    allExons = concat([panelBed[["chrom", "start", "end"]] for panelBed, panelName in panels]).drop_duplicates()
+    panelChrs = set(allExons["chrom"].unique())
+    panelRegions = {chrom: list(zip(exons["start"], exons["end"] + 1)) for chrom, exons in allExons.groupby("chrom")}
+    metricCols = metricColumns(thresholds)
+
+    with recorder.stage("load_coverage") as stage:
+        stage["rows"] = coverageRows(loadCoverageIndex(fullResCov, panelChrs, useCache=False))
+    cacheDir = join(outDir, "coverage_cache")
+    makedirs(cacheDir, exist_ok=True)
+    for path in coverage_cache_paths(fullResCov, cacheDir):
+        if exists(path): remove(path)
+    with recorder.stage("load_coverage_cache_write") as stage:
+        stage["rows"] = coverageRows(loadCoverageIndex(fullResCov, panelChrs, cacheDir=cacheDir))
+    if tabix_index_path(fullResCov + ".gz"):
+        with recorder.stage("load_coverage_tabix") as stage:
+            stage["rows"] = coverageRows(loadCoverageIndex(fullResCov + ".gz", panelChrs, panelRegions=panelRegions))
+    with recorder.stage("load_coverage_cached") as stage:
+        covIndex = loadCoverageIndex(fullResCov, panelChrs, cacheDir=cacheDir)
+        stage["rows"] = coverageRows(covIndex)
+
+    exonSheets, geneSheets, panelSheets = [], [], []
+    for panelBed, panelName in panels:
+        with recorder.stage("exon_overlap", rows=panelBed.shape[0]):
+            exonStats = exonCoverageStats(panelBed, covIndex, thresholds)
+
+        with recorder.stage("gene_panel_aggregation") as stage:
+            panelBed[metricCols] = coverageMetrics(exonStats, thresholds)
+            geneStats = exonStats.groupby(panelBed["gene"], sort=False).sum()
+            geneStats = geneStats[geneStats["Bases"] > 0]
+            panelGeneCov = coverageMetrics(geneStats, thresholds).rename_axis("gene").reset_index()
+            panelCov = coverageMetrics(geneStats.sum().to_frame().T, thresholds)
+            panelCov.insert(0, "Panel", panelName)
+            panelGeneCov["Panel"] = panelName
+            stage["rows"] = panelGeneCov.shape[0]
+        exonSheets.append(panelBed)
+        geneSheets.append(panelGeneCov)
+        panelSheets.append(panelCov)
+
+    makedirs(join(outDir, sampleName), exist_ok=True)
+    outName = join(outDir, sampleName, f"{sampleName}.qc_coverage_by_level.xlsx")
+    sheets = [("Exon Coverage", concat(exonSheets, ignore_index=True)), ("Gene Coverage", concat(geneSheets, ignore_index=True)),
+              ("Panel Coverage", concat(panelSheets, ignore_index=True))]
+    with recorder.stage("xlsx_write", rows=sheets[0][1].shape[0]):
+        writeCoverageWorkbook(outName, sheets, metricCols[1:])
+
+
+def benchmark(args):
+    sampleSheetDF = parseSampleSheet(join(args.data_dir, "SampleSheet.csv"))
+    bedFolder = join(args.data_dir, "beds")
+    outDir = join(args.data_dir, "benchmark_output")
+    recorder = StageRecorder()
+
+    workbooks = 0
+    for sampleName in sampleSheetDF["sample"]:
+        fullResCov = join(args.data_dir, "run", sampleName, sampleName + FULL_RES_SUFFIX)
+        if not exists(fullResCov): continue
+        print("Benchmarking", sampleName)
+        benchmarkSample(recorder, fullResCov, sampleName, sampleSheetDF, bedFolder, outDir)
+        workbooks += 1
+
+    # The Word summary is a standalone script, so it is timed as a subprocess and its CPU time and peak RSS are the child's
+    cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with recorder.stage("docx_summary", rows=workbooks):
+        run([executable, join(SCRIPT_DIR, "Gene_coverage_report1.py"), "-d", outDir], check=True, stdout=DEVNULL)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    recorder.stages["docx_summary"].update({"cpu_seconds": usage.ru_utime + usage.ru_stime - cpu.ru_utime - cpu.ru_stime,
+                                            "peak_rss_mb": usage.ru_maxrss / 1024})
+
+    results = {"host": node(), "python": python_version(), "data_dir": abspath(args.data_dir), "stages": recorder.stages}
+    with open(args.output, "w") as fh:
+        dump(results, fh, indent=2)
+    print("%-26s %10s %10s %12s %12s" % ("stage", "seconds", "cpu", "peak RSS MB", "rows"))
+    for stage, record in recorder.stages.items():
+        print("%-26s %10.3f %10.3f %12.1f %12i" % (stage, record["wall_seconds"], record["cpu_seconds"], record["peak_rss_mb"], record["rows"]))
+    print("Results written to", args.output)
+
+    if args.baseline:
+        return compareBaseline(results, args.baseline, args.tolerance)
+    return 0
+
+
+def renderDocx(renderer, path, panel_info, gene_lists, repeats):
+    '''
+    renderDocx writes the Word summary repeats times with one renderer and returns the fastest time and the
+    peak RSS of the process. It runs in a fresh process, so the peak RSS of the two renderers can be compared.
+    '''
+    seconds = []
+    for i in range(repeats):
+        wall = perf_counter()
+        if renderer == "python-docx":
+            render_summary(panel_info, gene_lists).save(path)
+        else:
+            write_summary_xml(path, panel_info, gene_lists)
+        seconds.append(perf_counter() - wall)
+    return min(seconds), peak_rss_mb()
+
+
+def docxBenchmark(args):
+    '''
+    docxBenchmark renders the same synthetic summary with both renderers of Gene_coverage_report1.py, prints their
+    time and peak RSS and checks that the two documents have the same parts.
+    '''
+    rng = np.random.default_rng(args.seed)
+    panel_info, gene_lists = {}, {}
+    for f in range(args.files):
+        file = "NGS26-%04i.qc_coverage_by_level.xlsx" % (1000 + f)
+        panel_info[file] = ("CGL%i" % (f % 3 + 1), float(rng.uniform(90, 100)))
+        low = rng.random(args.genes) < 0.05
+        gene_lists[file] = [("GENE%i%s" % (g, "*" if low[g] else ""), True) for g in range(args.genes)]
+    makedirs(args.out_dir, exist_ok=True)
+
+    results = {}
+    for renderer in ["python-docx", "xml"]:
+        path = join(args.out_dir, "gene_coverage_summary.%s.docx" % (renderer))
+        with get_context("spawn").Pool(1) as pool:
+            seconds, peak = pool.apply(renderDocx, (renderer, path, panel_info, gene_lists, args.repeats))
+        results[renderer] = {"seconds": seconds, "peak_mb": peak, "path": path}
+
+    print("%i files with %i genes each (%i genes)" % (args.files, args.genes, args.files * args.genes))
+    print("%-12s %10s %12s" % ("renderer", "seconds", "peak RSS MB"))
+    for renderer, record in results.items():
+        print("%-12s %10.3f %12.1f" % (renderer, record["seconds"], record["peak_mb"]))
+    print("Speed up: %.1fx" % (results["python-docx"]["seconds"] / results["xml"]["seconds"]))
+
+    with ZipFile(results["python-docx"]["path"]) as expected, ZipFile(results["xml"]["path"]) as actual:
+        same = expected.namelist() == actual.namelist() and all(expected.read(n) == actual.read(n) for n in expected.namelist())
+    print("The documents are", "identical" if same else "DIFFERENT")
+    return 0 if same else 1
+
+
+def compareBaseline(results, baselineName, tolerance):
+    '''
+    compareBaseline prints the time of every stage relative to the baseline results and returns 1 when a stage
+    is more than tolerance slower than in the baseline.
+    '''
+    with open(baselineName) as fh:
+        baseline = load(fh)
+    slower = []
+    print("%-26s %10s %10s %8s" % ("stage", "baseline", "current", "ratio"))
+    for stage, record in results["stages"].items():
+        if "wall_seconds" not in baseline["stages"].get(stage, {}): continue
+        before = baseline["stages"][stage]["wall_seconds"]
+        ratio = record["wall_seconds"] / before if before > 0 else 1.0
+        print("%-26s %10.3f %10.3f %8.2f" % (stage, before, record["wall_seconds"], ratio))
+        if ratio > 1 + tolerance: slower.append(stage)
+    if slower:
+        print("Slower than the baseline:", ", ".join(slower))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    if args.command == "generate":
+        generate(args)
+    elif args.command == "docx":
+        exit(docxBenchmark(args))
+    else:
+        exit(benchmark(args))
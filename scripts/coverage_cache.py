@@ -0,0 +1,217 @@
+from glob import glob
+from hashlib import sha1
+from json import dump as json_dump, load as json_load
+from os import environ, getpid, makedirs, replace, stat
+from os.path import abspath, basename, dirname, exists, expanduser, join, realpath
+from pickle import HIGHEST_PROTOCOL, dump, load
+import numpy as np
+from pandas import read_csv
+
+# The full resolution coverage is cached as a raw data file holding every interval start (int32), every
+# interval end (int32) and every coverage value (uint16, or float32 when the depths don't fit), one block
+# after the other, plus a small JSON file with the source file signature and the chromosome offset table.
+CACHE_VERSION = 1
+
+# The panel beds are parsed once into a pickled entry on local disk (see local_cache_dir) with these columns
+PANEL_BED_COLUMNS = ["chrom", "start", "end", "exIDs", "gene"]
+
+
+def file_signature(path):
+    """
+    Returns the size and modification time of a file, used to tell when a cache is stale.
+    """
+    st = stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def file_digest(path, use_cache=True):
+    """
+    Returns the SHA-1 of the content of a file. The digest is kept in the local cache (see local_cache_dir)
+    under the resolved path, size and modification time of the file, so an unchanged file is only read once,
+    even through the symlinks Nextflow stages in a new work folder for every attempt.
+    """
+    signature = file_signature(path)
+    source = realpath(path)
+    cache_path = None
+    if use_cache:
+        key = "%s\t%i\t%i" % (source, signature["size"], signature["mtime_ns"])
+        cache_path = join(local_cache_dir("digests"), sha1(key.encode()).hexdigest()[:16] + ".json")
+        try:
+            with open(cache_path) as fh:
+                entry = json_load(fh)
+            if entry.get("source") == signature:
+                return entry["sha1"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    digest = sha1()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+    digest = digest.hexdigest()
+    if cache_path is not None:
+        try:
+            with open(cache_path + ".tmp%i" % (getpid()), "w") as fh:
+                json_dump({"path": source, "source": signature, "sha1": digest}, fh)
+            replace(cache_path + ".tmp%i" % (getpid()), cache_path)
+        except OSError as e:
+            print(f"Could not write the digest cache for {path}: {e}")
+    return digest
+
+
+def local_cache_dir(*parts):
+    """
+    Returns (and creates) a folder of the local cache, e.g. local_cache_dir("panel_beds"). The local cache
+    is the folder named by the ICA_EMG_CACHE_DIR environment variable, or ~/.cache/ica-emedgene.
+    """
+    folder = join(environ.get("ICA_EMG_CACHE_DIR") or expanduser(join("~", ".cache", "ica-emedgene")), *parts)
+    makedirs(folder, exist_ok=True)
+    return folder
+
+
+def coverage_cache_paths(full_res, cache_dir=None):
+    """
+    Returns the (data, meta) sidecar paths for a full resolution BED file. The sidecar is named after the
+    resolved path of the BED file, so the symlinks Nextflow stages in a new work folder for every attempt share
+    it, and sits in the local cache (see local_cache_dir) unless a cache_dir is given.
+    """
+    source = realpath(full_res)
+    name = "%s.%s" % (basename(source), sha1(source.encode()).hexdigest()[:16])
+    prefix = join(cache_dir or local_cache_dir("coverage"), name)
+    return prefix + ".covcache", prefix + ".covcache.json"
+
+
+def _coverage_dtype(coverage):
+    if coverage.size == 0:
+        return np.uint16
+    integral = np.issubdtype(coverage.dtype, np.integer) or bool(np.all(np.mod(coverage, 1) == 0))
+    if integral and coverage.min() >= 0 and coverage.max() <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.float32
+
+
+def write_coverage_cache(full_res, cov_index, cache_dir=None):
+    """
+    Writes the per chromosome (starts, ends, coverage) arrays of cov_index to the sidecar of full_res.
+    Both files are written to a temporary name first and moved into place, so concurrent readers only
+    ever see a complete cache. Returns False when the sidecar location isn't writable.
+    """
+    data_path, meta_path = coverage_cache_paths(full_res, cache_dir)
+    chroms = list(cov_index.keys())
+    counts = [len(cov_index[chrom][0]) for chrom in chroms]
+    offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64))).tolist()
+    coverage = np.concatenate([cov_index[chrom][2] for chrom in chroms]) if chroms else np.zeros(0)
+    cov_dtype = _coverage_dtype(coverage)
+
+    meta = {
+        "version": CACHE_VERSION,
+        "source": file_signature(full_res),
+        "intervals": int(offsets[-1]),
+        "coverage_dtype": np.dtype(cov_dtype).name,
+        "chroms": [[chrom, offsets[i], counts[i]] for i, chrom in enumerate(chroms)],
+    }
+    tmp_suffix = ".tmp%i" % (getpid())
+    try:
+        with open(data_path + tmp_suffix, "wb") as fh:
+            for chrom in chroms:
+                fh.write(np.ascontiguousarray(cov_index[chrom][0], dtype=np.int32).tobytes())
+            for chrom in chroms:
+                fh.write(np.ascontiguousarray(cov_index[chrom][1], dtype=np.int32).tobytes())
+            fh.write(coverage.astype(cov_dtype).tobytes())
+        with open(meta_path + tmp_suffix, "w") as fh:
+            json_dump(meta, fh)
+        replace(data_path + tmp_suffix, data_path)
+        replace(meta_path + tmp_suffix, meta_path)
+    except OSError as e:
+        print(f"Could not write the coverage cache for {full_res}: {e}")
+        return False
+    return True
+
+
+def load_coverage_cache(full_res, chroms=None, cache_dir=None):
+    """
+    Memory-maps the sidecar of full_res and returns the per chromosome (starts, ends, coverage) index,
+    restricted to chroms when given. Returns None when there is no sidecar or when the size or
+    modification time of full_res no longer matches the one the sidecar was built from.
+    """
+    data_path, meta_path = coverage_cache_paths(full_res, cache_dir)
+    if not exists(data_path) or not exists(meta_path):
+        return None
+    try:
+        with open(meta_path) as fh:
+            meta = json_load(fh)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != CACHE_VERSION or meta.get("source") != file_signature(full_res):
+        return None
+
+    n = meta["intervals"]
+    cov_dtype = np.dtype(meta["coverage_dtype"])
+    if stat(data_path).st_size != n * 8 + n * cov_dtype.itemsize:
+        return None
+    if n == 0:
+        return {}
+    starts = np.memmap(data_path, dtype=np.int32, mode="r", offset=0, shape=(n,))
+    ends = np.memmap(data_path, dtype=np.int32, mode="r", offset=n * 4, shape=(n,))
+    coverage = np.memmap(data_path, dtype=cov_dtype, mode="r", offset=n * 8, shape=(n,))
+
+    cov_index = {}
+    for chrom, offset, count in meta["chroms"]:
+        if chroms is not None and chrom not in chroms:
+            continue
+        cov_index[chrom] = (starts[offset:offset + count], ends[offset:offset + count], coverage[offset:offset + count])
+    return cov_index
+
+
+def _panel_bed_cache_path(panel_bed_folder, cgl, cache_dir=None):
+    folder_key = sha1(abspath(panel_bed_folder).encode()).hexdigest()[:16]
+    return join(cache_dir or local_cache_dir("panel_beds"), folder_key, cgl + ".pkl")
+
+
+def load_panel_bed_entry(panel_bed_folder, cgl, cache_dir=None):
+    """
+    Returns the cache entry of <panel_bed_folder>/<cgl>.bed: a dictionary with the source signature and the
+    bed DataFrame in file order ("bed").
+    The bed file is only read when its size or modification time differs from the cached entry.
+    """
+    bed_path = join(panel_bed_folder, cgl + ".bed")
+    signature = file_signature(bed_path)
+    cache_path = _panel_bed_cache_path(panel_bed_folder, cgl, cache_dir)
+    if exists(cache_path):
+        try:
+            with open(cache_path, "rb") as fh:
+                entry = load(fh)
+            if entry.get("version") == CACHE_VERSION and entry.get("source") == signature:
+                return entry
+        except Exception:
+            pass
+
+    bed = read_csv(bed_path, names=PANEL_BED_COLUMNS, sep='\t')
+    bed["start"] = bed["start"].astype(np.int32)
+    bed["end"] = bed["end"].astype(np.int32)
+    entry = {"version": CACHE_VERSION, "source": signature, "bed": bed}
+    try:
+        makedirs(dirname(cache_path), exist_ok=True)
+        with open(cache_path + ".tmp%i" % (getpid()), "wb") as fh:
+            dump(entry, fh, protocol=HIGHEST_PROTOCOL)
+        replace(cache_path + ".tmp%i" % (getpid()), cache_path)
+    except OSError as e:
+        print(f"Could not write the panel bed cache for {bed_path}: {e}")
+    return entry
+
+
+def load_panel_bed(panel_bed_folder, cgl, cache_dir=None):
+    """
+    Returns a copy of the <panel_bed_folder>/<cgl>.bed DataFrame from the panel bed cache.
+    """
+    return load_panel_bed_entry(panel_bed_folder, cgl, cache_dir)["bed"].copy()
+
+
+def warm_panel_bed_cache(panel_bed_folder, cache_dir=None):
+    """
+    Makes sure every bed file in panel_bed_folder is in the panel bed cache. Returns the CGL names.
+    """
+    cgls = sorted(basename(bed_path)[:-len(".bed")] for bed_path in glob(join(panel_bed_folder, "*.bed")))
+    for cgl in cgls:
+        load_panel_bed_entry(panel_bed_folder, cgl, cache_dir)
+    return cgls
@@ -0,0 +1,74 @@
+from hashlib import sha1
+from json import dump, load
+from os import getpid, replace
+from os.path import exists, splitext
+
+# Every coverage workbook gets a manifest next to it (<sample>.qc_coverage_by_level.manifest.json) with the
+# digests of everything its content depends on: the full resolution BED, the code and thresholds, the sample
+# sheet row and the sample, CGL and bed digest of every panel. A rerun compares its own manifest to the stored
+# one and only recomputes the panels whose inputs changed.
+MANIFEST_VERSION = 1
+
+
+def manifest_path(out_name):
+    """
+    Returns the path of the manifest of the workbook out_name.
+    """
+    return splitext(out_name)[0] + ".manifest.json"
+
+
+def code_version(*paths):
+    """
+    Returns the SHA-1 of the source files that produce the workbook, so a code change invalidates old results.
+    """
+    digest = sha1()
+    for path in paths:
+        with open(path, "rb") as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()
+
+
+def read_manifest(out_name):
+    """
+    Returns the manifest stored next to the workbook out_name, or None when the workbook or its manifest is
+    missing or unreadable.
+    """
+    path = manifest_path(out_name)
+    if not exists(out_name) or not exists(path):
+        return None
+    try:
+        with open(path) as fh:
+            manifest = load(fh)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+
+def write_manifest(out_name, manifest):
+    """
+    Writes the manifest of the workbook out_name. It is written to a temporary name and moved into place,
+    and only after the workbook itself was saved, so a crash never leaves a manifest for a partial workbook.
+    """
+    path = manifest_path(out_name)
+    with open(path + ".tmp%i" % (getpid()), "w") as fh:
+        dump(dict(manifest, version=MANIFEST_VERSION), fh, indent=2)
+    replace(path + ".tmp%i" % (getpid()), path)
+
+
+def reusable_panels(previous, current):
+    """
+    Returns the positions of the panels of the current manifest whose rows can be copied from the workbook of
+    the previous manifest. That needs the same full resolution BED, code version and thresholds, and a panel
+    with the same sample, CGL and bed digest. The rows are found by CGL, so nothing is reused when a CGL
+    appears more than once.
+    """
+    if previous is None:
+        return set()
+    if any(previous.get(key) != current[key] for key in ("full_res", "code_version", "thresholds")):
+        return set()
+    previous_panels = previous.get("panels", [])
+    for panels in (previous_panels, current["panels"]):
+        cgls = [panel["cgl"] for panel in panels]
+        if len(set(cgls)) != len(cgls):
+            return set()
+    return {i for i, panel in enumerate(current["panels"]) if panel in previous_panels}
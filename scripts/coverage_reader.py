@@ -0,0 +1,226 @@
+from gzip import decompress as gzip_decompress
+from io import BytesIO
+from os.path import exists
+from struct import unpack_from
+from zlib import decompress as zlib_decompress
+import numpy as np
+from pandas import DataFrame, read_csv
+
+# Full resolution BED files are streamed in chunks of this many lines with compact column types
+CHUNK_LINES = 1000000
+COVERAGE_DTYPES = {"chrom": "category", "start": np.int32, "end": np.int32, "coverage": np.float32}
+
+# Reader for bgzip-compressed full resolution BED files indexed with tabix (tabix -p bed <file>.bed.gz).
+# Only the BGZF blocks that hold intervals overlapping the requested regions are decompressed, so the I/O
+# follows the size of the panel instead of the size of the exome.
+COVERAGE_COLUMNS = ["chrom", "start", "end", "coverage"]
+TABIX_MIN_SHIFT = 14  # Tabix indexes use 16kb linear index windows and the 5 level UCSC binning scheme
+
+
+def read_full_res_coverage(full_res, chroms=None, chunk_lines=CHUNK_LINES):
+    """
+    Streams a full resolution BED file (plain or gzipped) in chunks with a categorical chrom, int32 coordinates
+    and float32 coverage, keeping only the rows on chroms (all rows when chroms is None) as they are read.
+    Returns the per chromosome index of contiguous (starts, ends, coverage) arrays sorted by start, and the number
+    of rows read. Peak memory follows the kept rows plus one chunk, not the size of the file.
+    """
+    pieces = {}
+    rows_read = 0
+    reader = read_csv(full_res, sep="\t", header=None, names=COVERAGE_COLUMNS, usecols=[0, 1, 2, 3],
+                      dtype=COVERAGE_DTYPES, comment="#", chunksize=chunk_lines)
+    for chunk in reader:
+        rows_read += chunk.shape[0]
+        if chroms is not None:
+            chunk = chunk[chunk["chrom"].isin(chroms)]
+        for chrom, chrom_rows in chunk.groupby("chrom", sort=False, observed=True):
+            pieces.setdefault(chrom, []).append((chrom_rows["start"].to_numpy(), chrom_rows["end"].to_numpy(), chrom_rows["coverage"].to_numpy()))
+
+    cov_index = {}
+    for chrom, chrom_pieces in pieces.items():
+        starts, ends, coverage = (np.concatenate(column) for column in zip(*chrom_pieces))
+        del chrom_pieces[:]
+        if np.any(starts[1:] < starts[:-1]):
+            order = np.argsort(starts, kind="stable")
+            starts, ends, coverage = starts[order], ends[order], coverage[order]
+        cov_index[str(chrom)] = (starts, ends, coverage)
+    return cov_index, rows_read
+
+
+def tabix_index_path(full_res):
+    """
+    Returns the path of the tabix index of a bgzipped full resolution BED file, or None when there isn't one.
+    """
+    if full_res.endswith(".gz") and exists(full_res + ".tbi"):
+        return full_res + ".tbi"
+    return None
+
+
+def read_tabix_index(index_path):
+    """
+    Parses a tabix (.tbi) index into a dictionary of chrom -> (bins, linear_index), where bins maps a bin
+    number to its list of (begin, end) virtual file offsets and linear_index holds the smallest virtual
+    offset of every 16kb window.
+    """
+    with open(index_path, "rb") as fh:
+        data = gzip_decompress(fh.read())
+    if data[:4] != b"TBI\x01":
+        raise ValueError(f"{index_path} is not a tabix index")
+    n_ref = unpack_from("<i", data, 4)[0]
+    l_nm = unpack_from("<i", data, 32)[0]
+    names = data[36:36 + l_nm].split(b"\x00")[:n_ref]
+    pos = 36 + l_nm
+
+    index = {}
+    for name in names:
+        n_bin = unpack_from("<i", data, pos)[0]
+        pos += 4
+        bins = {}
+        for _ in range(n_bin):
+            bin_number, n_chunk = unpack_from("<Ii", data, pos)
+            pos += 8
+            chunks = unpack_from("<%iQ" % (2 * n_chunk), data, pos)
+            pos += 16 * n_chunk
+            bins[bin_number] = list(zip(chunks[0::2], chunks[1::2]))
+        n_intv = unpack_from("<i", data, pos)[0]
+        pos += 4
+        linear_index = unpack_from("<%iQ" % (n_intv), data, pos)
+        pos += 8 * n_intv
+        index[name.decode()] = (bins, linear_index)
+    return index
+
+
+def _region_bins(beg, end):
+    """
+    Returns the UCSC/tabix bins that can hold intervals overlapping the 0-based half open region [beg, end).
+    """
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def merge_regions(regions, gap=1 << TABIX_MIN_SHIFT):
+    """
+    Sorts the (start, end) regions of a chromosome and merges the ones that overlap or lie less than gap apart.
+    """
+    merged = []
+    for beg, end in sorted(regions):
+        if merged and beg <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([beg, end])
+    return merged
+
+
+def region_chunks(index, chrom, beg, end):
+    """
+    Returns the sorted and merged (begin, end) virtual offset chunks of the index that can hold intervals
+    overlapping the region [beg, end) of chrom. Chunks start no earlier than the linear index offset of the
+    region, since the file is sorted and no overlapping interval can start before it. htslib merges small
+    bins into their parents, so a chunk can still run well past the end of the region.
+    """
+    if chrom not in index:
+        return []
+    bins, linear_index = index[chrom]
+    window = beg >> TABIX_MIN_SHIFT
+    min_offset = linear_index[min(window, len(linear_index) - 1)] if linear_index else 0
+    chunks = []
+    for bin_number in _region_bins(beg, end):
+        chunks.extend((max(chunk[0], min_offset), chunk[1]) for chunk in bins.get(bin_number, []) if chunk[1] > min_offset)
+
+    merged = []
+    for chunk_beg, chunk_end in sorted(chunks):
+        if merged and chunk_beg <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], chunk_end)
+        else:
+            merged.append([chunk_beg, chunk_end])
+    return merged
+
+
+class BgzfReader:
+    """
+    Reads byte ranges of a BGZF (bgzip) file by virtual offset, decompressing each block only once in a row.
+    """
+
+    def __init__(self, path):
+        self.fh = open(path, "rb")
+        self.block_offset = None
+        self.block_data = b""
+        self.block_size = 0
+
+    def close(self):
+        self.fh.close()
+
+    def _load_block(self, offset):
+        if offset == self.block_offset:
+            return
+        self.fh.seek(offset)
+        header = self.fh.read(18)
+        if len(header) < 18:
+            self.block_offset, self.block_data, self.block_size = offset, b"", 0
+            return
+        xlen = unpack_from("<H", header, 10)[0]
+        extra = header[12:] + self.fh.read(xlen - 6)
+        block_size, pos = None, 0
+        while pos < xlen:
+            si1, si2, slen = extra[pos], extra[pos + 1], unpack_from("<H", extra, pos + 2)[0]
+            if si1 == 66 and si2 == 67:  # The BC subfield holds the total block size - 1
+                block_size = unpack_from("<H", extra, pos + 4)[0] + 1
+            pos += 4 + slen
+        if block_size is None:
+            raise ValueError(f"{self.fh.name} is not a bgzip compressed file")
+        compressed = self.fh.read(block_size - 12 - xlen - 8)
+        self.block_offset, self.block_data, self.block_size = offset, zlib_decompress(compressed, -15), block_size
+
+    def read_range(self, beg, end, past_region=None):
+        """
+        Returns the decompressed bytes between the virtual offsets beg and end. When past_region is given it is
+        called with the last complete line read so far after every block, and reading stops once it returns True.
+        """
+        coffset, uoffset = beg >> 16, beg & 0xFFFF
+        end_coffset, end_uoffset = end >> 16, end & 0xFFFF
+        parts = []
+        while coffset <= end_coffset:
+            self._load_block(coffset)
+            if self.block_size == 0:
+                break
+            part = self.block_data[uoffset:end_uoffset if coffset == end_coffset else len(self.block_data)]
+            parts.append(part)
+            coffset += self.block_size
+            uoffset = 0
+            if past_region is not None:
+                line_end = part.rfind(b"\n")
+                line_start = part.rfind(b"\n", 0, line_end) + 1
+                if line_end > 0 and line_start > 0 and past_region(part[line_start:line_end]):
+                    parts[-1] = part[:line_end + 1]  # Drop the partial line at the end of the block
+                    break
+        return b"".join(parts)
+
+
+def read_region_coverage(full_res, regions, index_path=None):
+    """
+    Reads the intervals of a bgzipped and tabix indexed full resolution BED file that overlap regions
+    (chrom -> list of (start, end)) into a (chrom, start, end, coverage) DataFrame. Nearby regions are read
+    together, so intervals lying between them can be returned too.
+    """
+    index = read_tabix_index(index_path or tabix_index_path(full_res))
+    reader = BgzfReader(full_res)
+    parts = []
+    try:
+        for chrom, chrom_regions in regions.items():
+            chrom_bytes = chrom.encode()
+            for beg, end in merge_regions(chrom_regions):
+                def past_region(line):
+                    fields = line.split(b"\t", 2)
+                    return fields[0] != chrom_bytes or int(fields[1]) >= end
+                for chunk_beg, chunk_end in region_chunks(index, chrom, beg, end):
+                    parts.append(reader.read_range(chunk_beg, chunk_end, past_region))
+    finally:
+        reader.close()
+    text = b"".join(parts)
+    if not text.strip():
+        return DataFrame({col: [] for col in COVERAGE_COLUMNS})
+    coverage_data = read_csv(BytesIO(text), sep="\t", header=None, names=COVERAGE_COLUMNS, comment="#", dtype={"chrom": str})
+    coverage_data = coverage_data[coverage_data["chrom"].isin(regions.keys())]
+    return coverage_data.drop_duplicates(subset=["chrom", "start", "end"]).reset_index(drop=True)
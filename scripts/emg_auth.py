@@ -0,0 +1,154 @@
+from hashlib import sha1
+from json import dump, load
+from os import O_CREAT, O_TRUNC, O_WRONLY, chmod, fdopen, getpid, open as os_open, remove, replace, stat
+from os.path import join
+from threading import Lock
+from time import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from coverage_cache import local_cache_dir
+
+# Every Emedgene call of a process goes through one requests.Session, so the TLS connection is kept alive and
+# reused, and failed connections and 429/5xx responses are retried with an exponential backoff. The bearer token
+# of a host and user is kept in the local cache (see local_cache_dir) in a file only the user can read, and is
+# reused by later runs until it is close to expiring, instead of logging in on every run. A token Emedgene rejects
+# with a 401 before then (revoked, or a shorter lifetime than assumed) is dropped from the cache (see EmgToken).
+LOGIN_ROUTE = "/api/auth/v2/api_login/"
+TOKEN_LIFETIME = 30 * 60  # Seconds a token is assumed to be valid when the login doesn't return expires_in
+TOKEN_MARGIN = 5 * 60  # A cached token is replaced this many seconds before it expires
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+REFUSED_STATUSES = (429, 503)  # The server didn't act on the request, so even a POST can be sent again
+
+_session = None
+_pool_size = 0
+
+
+class EmgRetry(Retry):
+    """
+    Retries requests answered with one of RETRY_STATUSES, except that a POST (a login or a new case) is only
+    retried when the server refused it, so a case is never created twice.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST":
+            return bool(self.total) and status_code in REFUSED_STATUSES
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def emg_session(retries=3, backoff=0.5, pool_size=16):
+    """
+    Returns the shared requests.Session of this process, creating it on the first call. Requests whose
+    connection fails and requests answered with 429 or 5xx (see EmgRetry) are retried up to retries times,
+    waiting backoff, 2 * backoff, 4 * backoff ... seconds. Asking for a larger pool_size (e.g. for more submission
+    threads) replaces the connection pool.
+    """
+    global _session, _pool_size
+    if _session is None or pool_size > _pool_size:
+        retry = EmgRetry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES, raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        _session = _session or requests.Session()
+        _pool_size = pool_size
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+
+def _token_cache_path(host, username):
+    folder = local_cache_dir("emg_auth")
+    chmod(folder, 0o700)
+    return join(folder, sha1(f"{host}\t{username}".encode()).hexdigest()[:16] + ".json")
+
+
+def _read_cached_token(cache_path, host, username):
+    try:
+        if stat(cache_path).st_mode & 0o077:
+            return None  # Don't trust a token file others can read or write
+        with open(cache_path) as fh:
+            entry = load(fh)
+        if entry["host"] == host and entry["username"] == username and entry["expires_at"] - TOKEN_MARGIN > time():
+            return entry["token"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _write_cached_token(cache_path, entry):
+    try:
+        with fdopen(os_open(cache_path + ".tmp%i" % (getpid()), O_WRONLY | O_CREAT | O_TRUNC, 0o600), "w") as fh:
+            dump(entry, fh)
+        replace(cache_path + ".tmp%i" % (getpid()), cache_path)
+    except OSError as e:
+        print(f"Could not write the token cache {cache_path}: {e}")
+
+
+def emg_login(host, username, password, use_cache=True):
+    """
+    Returns the Authorization header value ("Bearer <token>") for a user on an Emedgene host, e.g.
+    https://pch-production.emg.illumina.com. A cached token that is still valid is returned without logging in.
+    """
+    cache_path = _token_cache_path(host, username) if use_cache else None
+    if cache_path is not None:
+        token = _read_cached_token(cache_path, host, username)
+        if token is not None:
+            return token
+
+    response = emg_session().post(host + LOGIN_ROUTE, json={"username": username, "password": password})
+    response.raise_for_status()
+    login = response.json()
+    token = f'{login["token_type"].capitalize()} {login["access_token"]}'
+    if cache_path is not None:
+        expires_at = time() + float(login.get("expires_in") or TOKEN_LIFETIME)
+        _write_cached_token(cache_path, {"host": host, "username": username, "token": token, "expires_at": expires_at})
+    return token
+
+
+def forget_token(host, username):
+    """
+    Removes the cached token of a user, e.g. after Emedgene rejected it with a 401.
+    """
+    try:
+        remove(_token_cache_path(host, username))
+    except OSError:
+        pass
+
+
+class EmgToken:
+    """
+    The Authorization header of a user on a host, shared by all the threads of an upload. After Emedgene
+    answered a request made with a token with a 401, refresh(rejected) removes the cached token, logs in again and
+    returns the new token. The threads rejected with the same token share a single new login.
+
+    verified() returns a token from a login of this process, logging in once when the token came from the cache,
+    for uploads that can't tell a rejected token from another failure (BatchCasesCreator.js).
+
+        token = EmgToken(host, username, password)
+        results = submit_cases(rows, host, token.value, refresh=token.refresh)
+    """
+
+    def __init__(self, host, username, password, use_cache=True):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.use_cache = use_cache
+        self.lock = Lock()
+        self.logged_in = not use_cache or _read_cached_token(_token_cache_path(host, username), host, username) is None
+        self.value = emg_login(host, username, password, use_cache)
+
+    def verified(self):
+        with self.lock:
+            if not self.logged_in:
+                forget_token(self.host, self.username)
+                self.value = emg_login(self.host, self.username, self.password, self.use_cache)
+                self.logged_in = True
+            return self.value
+
+    def refresh(self, rejected):
+        with self.lock:
+            if self.value == rejected:
+                print(f"Emedgene rejected the token of {self.username}, logging in again")
+                forget_token(self.host, self.username)
+                self.value = emg_login(self.host, self.username, self.password, self.use_cache)
+                self.logged_in = True
+            return self.value
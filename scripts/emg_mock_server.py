@@ -0,0 +1,127 @@
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from random import Random
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from emg_auth import LOGIN_ROUTE
+from emg_submit import CASES_ROUTE, submit_cases
+
+# A local stand in for the Emedgene login and case creation API, for trying the upload scripts (--emg_host
+# http://127.0.0.1:<port>) and for benchmarking the submission engine without touching a real Emedgene host.
+# It accepts the request emg_submit.py sends, which isn't verified against the Emedgene API (see emg_submit.py),
+# so the benchmark measures the concurrency of the engine, not the throughput of Emedgene.
+# Every case takes latency seconds to create, and fail_rate of the cases are rejected with a 500. Every login gets
+# a new token valid for token_lifetime seconds (expires_in is left out when it is None), and cases posted with a
+# token in revoked are rejected with a 401.
+
+
+def create_parser():
+    parser = ArgumentParser(description="Run a mock Emedgene server, or benchmark the case submission engine against one.")
+    parser.add_argument("--port", type=int, default=0, help="The port to listen on (default: any free port).")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the server takes to create a case (default: 0.05).")
+    parser.add_argument("--fail_rate", type=float, default=0.0, help="Fraction of the cases that fail with a 500 (default: 0).")
+    parser.add_argument("--benchmark", action="store_true", help="Submit synthetic cases at every --concurrency and print the throughput, instead of serving.")
+    parser.add_argument("--cases", type=int, default=200, help="Number of synthetic cases of the benchmark (default: 200).")
+    parser.add_argument("--concurrency", type=lambda t: [int(x) for x in t.split(',')], default=[1, 4, 16],
+                        help="Comma separated numbers of concurrent submissions to benchmark (default: 1,4,16).")
+    return parser
+
+
+class MockEmedgene(ThreadingHTTPServer):
+    """
+    Serves LOGIN_ROUTE and CASES_ROUTE on 127.0.0.1 from a background thread and keeps the created cases
+    (family id -> number of times created) and the number of logins. Use it as a context manager:
+
+        with MockEmedgene(latency=0.05) as server:
+            submit_cases(rows, server.host, "Bearer mock-token")
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.05, fail_rate=0.0, seed=1, token_lifetime=3600):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.host = "http://127.0.0.1:%i" % (self.server_address[1])
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.token_lifetime = token_lifetime
+        self.revoked = set()
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.logins = 0
+        self.cases = {}
+
+    def __enter__(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # Headers and body are written separately, don't wait for an ACK in between
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        request = loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server = self.server
+        if self.path == LOGIN_ROUTE:
+            with server.lock:
+                server.logins += 1
+                login = {"access_token": "mock-token-%i" % (server.logins), "token_type": "bearer"}
+            if server.token_lifetime is not None:
+                login["expires_in"] = server.token_lifetime
+            return self.reply(200, login)
+        if self.path != CASES_ROUTE:
+            return self.reply(404, {"error": "Unknown route %s" % (self.path)})
+        token = self.headers.get("Authorization", "")
+        if not token.startswith("Bearer ") or token in server.revoked:
+            return self.reply(401, {"error": "Not logged in"})
+        sleep(server.latency)
+        with server.lock:
+            if server.random.random() < server.fail_rate:
+                return self.reply(500, {"error": "Mock failure"})
+            server.cases[request["Family Id"]] = server.cases.get(request["Family Id"], 0) + 1
+            caseID = "EMG%06i" % (sum(server.cases.values()))
+        return self.reply(200, {"id": caseID, "family_id": request["Family Id"]})
+
+
+def syntheticCases(count):
+    return [{"Family Id": "NGS26-%04i_CGL%i" % (i, i % 7 + 1), "Case Type": "Exome", "BioSample Name": "NGS26-%04i" % (i)} for i in range(count)]
+
+
+def benchmark(args):
+    rows = syntheticCases(args.cases)
+    print("%-12s %10s %12s %8s" % ("concurrency", "seconds", "cases/sec", "failed"))
+    for concurrency in args.concurrency:
+        with MockEmedgene(latency=args.latency, fail_rate=args.fail_rate) as server:
+            start = perf_counter()
+            results = submit_cases(rows, server.host, "Bearer mock-token", concurrency=concurrency)
+            seconds = perf_counter() - start
+        failed = sum(1 for result in results if result["status"] != "created")
+        print("%-12i %10.2f %12.1f %8i" % (concurrency, seconds, len(rows) / seconds, failed))
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    if args.benchmark:
+        benchmark(args)
+    else:
+        with MockEmedgene(args.port, args.latency, args.fail_rate) as server:
+            print("Mock Emedgene server listening on", server.host)
+            try:
+                while True: sleep(3600)
+            except KeyboardInterrupt:
+                pass
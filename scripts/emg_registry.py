@@ -0,0 +1,95 @@
+from collections.abc import Mapping
+from hashlib import sha1
+from os import getpid, replace
+from os.path import abspath, join
+from pickle import HIGHEST_PROTOCOL, dump, load
+from pandas import read_excel
+from coverage_cache import file_signature, local_cache_dir
+
+# The Emedgene intersect bed and gene list IDs of every CGL panel are kept in two column spreadsheets on the
+# network share (CGL, ID). The upload scripts only read them when a case is built: the first lookup stats the
+# spreadsheet and loads the mapping from a pickled copy in the local cache (see local_cache_dir), and the
+# spreadsheet itself is only read again when its size or modification time changes.
+REGISTRY_VERSION = 1
+
+
+def _registry_cache_path(source):
+    return join(local_cache_dir("reference_ids"), sha1(abspath(source).encode()).hexdigest()[:16] + ".pickle")
+
+
+def read_reference_ids(source, column, lenient=False):
+    """
+    Reads a (CGL, column) spreadsheet into a CGL -> ID string dict. Later rows replace earlier rows of the same
+    CGL. An ID that isn't a number raises a ValueError, or is stored as '' when lenient.
+    """
+    idsDF = read_excel(source, header=None, names=["CGL", column])
+    ids = {}
+    for cgl, value in zip(idsDF["CGL"].tolist(), idsDF[column].tolist()):
+        try:
+            ids[cgl] = str(int(value))
+        except (ValueError, TypeError, OverflowError):
+            if not lenient:
+                raise ValueError(f"The {column} of {cgl} in {source} is not a number: {value}")
+            ids[cgl] = ''
+    return ids
+
+
+class ReferenceIDs(Mapping):
+    """
+    A CGL -> ID mapping that is loaded from its spreadsheet on first use, through the local cache. The extra
+    entries (e.g. {'': ''} for samples without a panel) are added on top of the spreadsheet.
+
+        bedIDs = ReferenceIDs("/mnt/genomics/R_and_D/wes/refFiles/ProductionIntersectBeds.xlsx", "bed_id")
+        intersectBed = bedIDs["CGL1"]
+    """
+
+    def __init__(self, source, column, lenient=False, extra=None, use_cache=True):
+        self.source = source
+        self.column = column
+        self.lenient = lenient
+        self.extra = dict(extra or {})
+        self.use_cache = use_cache
+        self._ids = None
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = self._load()
+            self._ids.update(self.extra)
+        return self._ids
+
+    def _load(self):
+        signature = file_signature(self.source)
+        settings = {"column": self.column, "lenient": self.lenient}
+        cache_path = _registry_cache_path(self.source) if self.use_cache else None
+        if cache_path is not None:
+            try:
+                with open(cache_path, "rb") as fh:
+                    entry = load(fh)
+                if entry.get("version") == REGISTRY_VERSION and entry.get("source") == signature and entry.get("settings") == settings:
+                    return entry["ids"]
+            except Exception:
+                pass
+
+        ids = read_reference_ids(self.source, self.column, self.lenient)
+        if cache_path is not None:
+            try:
+                with open(cache_path + ".tmp%i" % (getpid()), "wb") as fh:
+                    dump({"version": REGISTRY_VERSION, "path": abspath(self.source), "source": signature, "settings": settings, "ids": ids},
+                         fh, protocol=HIGHEST_PROTOCOL)
+                replace(cache_path + ".tmp%i" % (getpid()), cache_path)
+            except OSError as e:
+                print(f"Could not write the reference ID cache for {self.source}: {e}")
+        return ids
+
+    def __getitem__(self, cgl):
+        return self.ids[cgl]
+
+    def __contains__(self, cgl):
+        return cgl in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
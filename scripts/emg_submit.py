@@ -0,0 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor
+from json import dump, load
+from os import getpid, replace
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+from urllib.parse import urlparse
+import requests
+from urllib3.exceptions import NewConnectionError
+from emg_auth import emg_session
+
+# Creates the cases of a batch upload with the Emedgene API instead of the BatchCasesCreator.js CLI. Every case
+# (a row of build_sample, i.e. the columns of the batch CSV) is posted on a pool of threads sharing the pooled
+# session of emg_auth, at most concurrency at a time and no more than rate per second, and every case gets its own
+# result, so a failed case can be told apart from the ones that were created.
+#
+# The route and the body (the batch CSV columns of a case as JSON, see case_request) are NOT verified against the
+# Emedgene API: BatchCasesCreator.js isn't part of this repository, so the request it sends for a CSV row could not
+# be checked. Until case_request is built from the request BatchCasesCreator.js sends, the upload scripts don't
+# use this engine, and it only runs against emg_mock_server.py (which accepts this same request).
+CASES_ROUTE = "/api/cases/v2/cases/"
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")  # The only hosts submit_cases sends the unverified request to
+
+# submit_chunks splits a batch into chunks that are submitted in parallel and keeps the result of every case in
+# a JSON state file, so a rerun with resume only sends the cases that failed. A case is "unknown" when the upload
+# may have created it (e.g. BatchCasesCreator.js failed part way through a batch): it is never sent again on its
+# own, someone has to check it in Emedgene first.
+STATE_VERSION = 1
+SETTLED_STATUSES = ("created", "unknown")  # Cases with these statuses are not sent again
+
+
+class RateLimiter:
+    """
+    Spaces the calls of all threads to wait() at least 1 / rate seconds apart. A rate of 0 or None doesn't limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = Lock()
+        self.next_slot = monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+
+def case_result(row, status="failed", http_status=None, detail="", seconds=0.0, sent=True):
+    return {"family_id": row["Family Id"], "status": status, "http_status": http_status, "detail": detail, "seconds": seconds, "sent": sent}
+
+
+def case_request(row):
+    """
+    Returns the JSON body that creates the case of a batch CSV row (see the unverified request note above).
+    """
+    return dict(row)
+
+
+def _not_sent(error):
+    """
+    Tells whether a request failed before it reached the server: the connection was refused or timed out.
+    """
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.ConnectTimeout) or (isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError))
+
+
+def create_case(row, host, token, limiter, timeout=60):
+    """
+    Posts one case and returns its result: {"family_id", "status", "http_status", "detail" (the start of the
+    response, or the error), "seconds"}. The status is "created", "failed" when the server refused the case (4xx)
+    or never got it (no connection), and "unknown" when it may have created it (5xx, or the connection broke or
+    timed out after the case was sent).
+    """
+    start = perf_counter()
+    limiter.wait()
+    result = case_result(row)
+    try:
+        response = emg_session().post(host + CASES_ROUTE, json=case_request(row), headers={"Authorization": token}, timeout=timeout)
+        result["http_status"] = response.status_code
+        result["detail"] = response.text[:200].replace('\t', ' ').replace('\n', ' ')
+        if response.ok:
+            result["status"] = "created"
+        elif response.status_code >= 500:
+            result["status"] = "unknown"
+    except requests.RequestException as e:
+        result["detail"] = str(e).replace('\t', ' ').replace('\n', ' ')
+        if not _not_sent(e):
+            result["status"] = "unknown"
+    result["seconds"] = perf_counter() - start
+    return result
+
+
+def submit_cases(rows, host, token, concurrency=8, rate=None, timeout=60, limiter=None, refresh=None):
+    """
+    Creates every case of rows on host, concurrency at a time and at most rate per second (or as fast as a
+    RateLimiter shared with other calls allows), and returns the results of create_case in the order of rows.
+    With refresh (e.g. EmgToken.refresh), the cases rejected with a 401 are sent once more with the token
+    refresh(token) returns; a 401 means the case wasn't created, so it can't be created twice. Raises a ValueError
+    for a host other than a local mock server (see LOCAL_HOSTS).
+    """
+    if urlparse(host).hostname not in LOCAL_HOSTS:
+        raise ValueError(f"The case request of emg_submit.py isn't verified against the Emedgene API, it is only sent to a local mock server, not {host}")
+    limiter = limiter or RateLimiter(rate)
+    emg_session(pool_size=max(concurrency, 1))
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(rows)))) as pool:
+        results = list(pool.map(lambda row: create_case(row, host, token, limiter, timeout), rows))
+        rejected = [i for i, result in enumerate(results) if result["http_status"] == 401]
+        if refresh is not None and rejected:
+            token = refresh(token)
+            for i, result in zip(rejected, pool.map(lambda i: create_case(rows[i], host, token, limiter, timeout), rejected)):
+                results[i] = result
+    return results
+
+
+def load_state(state_path, family_ids, chunk_size):
+    """
+    Returns the chunks of a previous submission of the same cases with the same chunk size. Raises a ValueError
+    when the state file is for other cases.
+    """
+    with open(state_path) as fh:
+        state = load(fh)
+    if state.get("version") != STATE_VERSION or state.get("family_ids") != family_ids or state.get("chunk_size") != chunk_size:
+        raise ValueError(f"The state file {state_path} is for other cases or another chunk size, remove it or run without resuming")
+    return state["chunks"]
+
+
+def save_state(state_path, family_ids, chunk_size, chunks):
+    with open(state_path + ".tmp%i" % (getpid()), "w") as fh:
+        dump({"version": STATE_VERSION, "family_ids": family_ids, "chunk_size": chunk_size, "chunks": chunks}, fh, indent=1)
+    replace(state_path + ".tmp%i" % (getpid()), state_path)
+
+
+def submit_chunks(rows, submit_chunk, state_path, chunk_size=25, parallel_chunks=4, resume=False):
+    """
+    Splits rows into chunks of chunk_size cases and calls submit_chunk(chunk_rows) on parallel_chunks chunks at
+    a time. submit_chunk returns the case_result of every row it was given (with sent False for the rows it didn't
+    send, e.g. the ones the upload ledger skipped). After every chunk the results are
+    written to the state file, a chunk being "done" when all its cases were created, "unknown" when the others
+    are unknown and "failed" otherwise.
+
+    With resume, only the chunks of the state file that failed are submitted again, with the cases that failed
+    (see SETTLED_STATUSES). Returns the latest result of every case, in the order of rows.
+    """
+    family_ids = [row["Family Id"] for row in rows]
+    chunk_size = chunk_size if chunk_size > 0 else max(1, len(rows))
+    if resume:
+        chunks = load_state(state_path, family_ids, chunk_size)
+    else:
+        chunks = [{"status": "unsent", "results": [None] * len(rows[i:i + chunk_size])} for i in range(0, len(rows), chunk_size)]
+        save_state(state_path, family_ids, chunk_size, chunks)
+    lock = Lock()
+
+    def run_chunk(c):
+        chunk = chunks[c]
+        todo = [i for i, result in enumerate(chunk["results"]) if result is None or result["status"] not in SETTLED_STATUSES]
+        chunk_rows = [rows[c * chunk_size + i] for i in todo]
+        try:
+            results = submit_chunk(chunk_rows)
+        except Exception as e:
+            results = [case_result(row, detail=f"The chunk could not be submitted: {e}") for row in chunk_rows]
+        with lock:
+            for i, result in zip(todo, results):
+                chunk["results"][i] = result
+            statuses = set(result["status"] if result else "unsent" for result in chunk["results"])
+            chunk["status"] = "done" if statuses == {"created"} else "unknown" if statuses <= set(SETTLED_STATUSES) else "failed"
+            save_state(state_path, family_ids, chunk_size, chunks)
+            print("Chunk %i of %i %s: sent %i cases, %i of %i created" % (c + 1, len(chunks), chunk["status"], sum(1 for result in results if result.get("sent", True)),
+                  sum(1 for result in chunk["results"] if result and result["status"] == "created"), len(chunk["results"])))
+
+    pending = [c for c, chunk in enumerate(chunks) if chunk["status"] not in SETTLED_STATUSES + ("done",)]
+    print("Submitting %i of %i chunks (%i cases per chunk) to the state file %s" % (len(pending), len(chunks), chunk_size, state_path))
+    with ThreadPoolExecutor(max_workers=max(1, min(parallel_chunks, len(pending)))) as pool:
+        list(pool.map(run_chunk, pending))
+    return [result or case_result(rows[c * chunk_size + i], "unsent") for c, chunk in enumerate(chunks) for i, result in enumerate(chunk["results"])]
+
+
+def print_results(results):
+    """
+    Prints one line per case and a count of the created, failed and unknown cases. Returns the number of cases
+    that were not created.
+    """
+    for result in results:
+        print("%s\t%s\t%s\t%.1f\t%s" % (result["family_id"], result["status"], result["http_status"], result["seconds"], result["detail"]))
+    unknown = sum(1 for result in results if result["status"] == "unknown")
+    failed = sum(1 for result in results if result["status"] not in SETTLED_STATUSES)
+    print("Created %i cases, %i failed, %i unknown." % (len(results) - failed - unknown, failed, unknown))
+    if unknown:
+        print("The unknown cases may have been created: they are not sent again. Check them in Emedgene, and remove the ones "
+              "that are missing from the upload ledger (upload_ledger.py forget) and upload without --resume to send them.")
+    return failed + unknown
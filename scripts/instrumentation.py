@@ -0,0 +1,72 @@
+from contextlib import contextmanager
+from cProfile import Profile
+from datetime import datetime
+from json import dump
+from sys import argv, platform
+from time import perf_counter, process_time
+import resource
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process so far in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if platform == "darwin" else peak / 1024  # macOS reports bytes, Linux reports KB
+
+
+class StageRecorder:
+    """
+    Records the wall time, CPU time, peak RSS and row count of named stages of a script. Stages that run more
+    than once (e.g. once per panel) are added up. Recording is cheap, so scripts always record and only write
+    the JSON sidecar (write) or the cProfile dump (start_profile/dump_profile) when asked to.
+
+        recorder = StageRecorder()
+        with recorder.stage("read_csv") as stage:
+            df = read_csv(...)
+            stage["rows"] = df.shape[0]
+        recorder.write("<output>.timings.json")
+    """
+
+    def __init__(self):
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.stages = {}
+        self.profiler = None
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        record = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": 0.0, "rows": 0, "calls": 0})
+        current = {"rows": rows}
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield current
+        finally:
+            record["wall_seconds"] += perf_counter() - wall
+            record["cpu_seconds"] += process_time() - cpu
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], peak_rss_mb())
+            record["rows"] += current["rows"] or 0
+            record["calls"] += 1
+
+    def start_profile(self):
+        self.profiler = Profile()
+        self.profiler.enable()
+
+    def dump_profile(self, path):
+        """
+        Stops the profiler started with start_profile and writes its stats to path (readable with pstats or snakeviz).
+        """
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        self.profiler.dump_stats(path)
+        print(f"Saved the profile: {path}")
+
+    def write(self, path, **extra):
+        """
+        Writes the recorded stages, the command line and any extra values to a JSON file at path.
+        """
+        summary = {"command": argv, "started": self.started, "peak_rss_mb": peak_rss_mb(), "stages": self.stages}
+        summary.update(extra)
+        with open(path, "w") as fh:
+            dump(summary, fh, indent=2)
+        print(f"Saved the stage timings: {path}")
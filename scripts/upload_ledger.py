@@ -0,0 +1,180 @@
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from hashlib import sha1
+from json import dumps
+from os.path import join
+from sqlite3 import connect as sqlite_connect
+from coverage_cache import local_cache_dir
+from emg_submit import SETTLED_STATUSES, case_result
+
+# The upload ledger is a SQLite database with one row per (environment, family id) of every case an upload script
+# sent to Emedgene: the run folder, a hash of the case, the status ("submitting", "created", "unknown" or "failed"),
+# the start of the response and the number of attempts. Cases that are created, may have been created (unknown,
+# see emg_submit.py, or left "submitting" by an upload that died) or are being created by another upload are not
+# sent again, so a retried upload only creates
+# the cases that are missing. A case created from another run folder with another payload (e.g. a sample that was
+# sequenced again) is not sent either: it fails until it is removed from the ledger with the forget command. The database runs in
+# WAL mode and every claim is one immediate transaction, so concurrent uploads never claim the same case. Keep
+# it on a local disk: SQLite locking isn't reliable on NFS.
+BUSY_TIMEOUT_SECONDS = 120
+LEASE_MINUTES = 30  # A case left "submitting" for longer than this was left by an upload that died: it becomes "unknown"
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS uploads (
+           environment TEXT NOT NULL, family_id TEXT NOT NULL, run TEXT, payload_hash TEXT, status TEXT NOT NULL,
+           detail TEXT, attempts INTEGER NOT NULL DEFAULT 0, updated TEXT NOT NULL,
+           PRIMARY KEY (environment, family_id)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS uploads_run ON uploads (run)",
+]
+
+
+def default_ledger():
+    return join(local_cache_dir(), "upload_ledger.sqlite")
+
+
+def connect(db_path):
+    """
+    Opens (and creates) the upload ledger at db_path in WAL mode. Writers wait up to BUSY_TIMEOUT_SECONDS for
+    each other instead of failing.
+    """
+    con = sqlite_connect(db_path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    for statement in SCHEMA:
+        con.execute(statement)
+    return con
+
+
+def payload_hash(row):
+    return sha1(dumps(row, sort_keys=True).encode()).hexdigest()
+
+
+def claim_cases(db_path, environment, run, rows):
+    """
+    Returns the rows that should be sent and the results of the rows that shouldn't, by index: the cases that
+    were created from the same run folder or payload or may have been created, the cases created from another run
+    folder with another payload (failed), and the cases another upload started less than LEASE_MINUTES ago. A case
+    left "submitting" for longer by an upload that died may have been created, so it is marked "unknown". The
+    rows that are returned are marked "submitting" in the same transaction.
+    """
+    now = datetime.now()
+    lease = (now - timedelta(minutes=LEASE_MINUTES)).isoformat(timespec="seconds")
+    send, known, sending, stale = [], {}, set(), []
+    con = connect(db_path)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        for i, row in enumerate(rows):
+            entry = con.execute("SELECT run, payload_hash, status, updated FROM uploads WHERE environment = ? AND family_id = ?",
+                                (environment, row["Family Id"])).fetchone()
+            if entry is not None and entry[2] == "created" and (entry[0] == run or entry[1] == payload_hash(row)):
+                known[i] = case_result(row, "created", detail=f"Already created by {entry[0]} on {entry[3]} (upload ledger)", sent=False)
+            elif entry is not None and entry[2] == "created":
+                known[i] = case_result(row, "failed", detail=f"Created by {entry[0]} on {entry[3]} with another payload, run upload_ledger.py "
+                                                              f"-e {environment} forget {row['Family Id']} to create it again (upload ledger)", sent=False)
+            elif entry is not None and entry[2] == "unknown":
+                known[i] = case_result(row, "unknown", detail=f"May have been created by {entry[0]} on {entry[3]}, check it in Emedgene "
+                                                               f"and run upload_ledger.py -e {environment} forget {row['Family Id']} to send it again (upload ledger)", sent=False)
+            elif entry is not None and entry[2] == "submitting" and entry[3] > lease:
+                known[i] = case_result(row, "failed", detail=f"Being submitted by {entry[0]} since {entry[3]} (upload ledger)", sent=False)
+            elif entry is not None and entry[2] == "submitting":
+                known[i] = case_result(row, "unknown", detail=f"The upload of {entry[0]} stopped while submitting it on {entry[3]}, check it in Emedgene "
+                                                               f"and run upload_ledger.py -e {environment} forget {row['Family Id']} to send it again (upload ledger)", sent=False)
+                stale.append(i)
+            elif row["Family Id"] in sending:
+                known[i] = case_result(row, "failed", detail="Listed twice in this upload, only the first was sent (upload ledger)", sent=False)
+            else:
+                send.append(i)
+                sending.add(row["Family Id"])
+        con.executemany("""INSERT INTO uploads (environment, family_id, run, payload_hash, status, attempts, updated)
+                           VALUES (?, ?, ?, ?, 'submitting', 1, ?)
+                           ON CONFLICT (environment, family_id) DO UPDATE SET run = excluded.run, payload_hash = excluded.payload_hash,
+                           status = 'submitting', detail = NULL, attempts = attempts + 1, updated = excluded.updated""",
+                        [(environment, rows[i]["Family Id"], run, payload_hash(rows[i]), now.isoformat(timespec="seconds")) for i in send])
+        con.executemany("UPDATE uploads SET status = 'unknown', detail = ? WHERE environment = ? AND family_id = ?",
+                        [(known[i]["detail"], environment, rows[i]["Family Id"]) for i in stale])
+        con.execute("COMMIT")
+    finally:
+        con.close()
+    return send, known
+
+
+def record_results(db_path, environment, results):
+    """
+    Stores the status and detail of the results of submit_cases (or node_chunk_upload) in the ledger.
+    """
+    updated = datetime.now().isoformat(timespec="seconds")
+    con = connect(db_path)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        con.executemany("UPDATE uploads SET status = ?, detail = ?, updated = ? WHERE environment = ? AND family_id = ?",
+                        [(result["status"] if result["status"] in SETTLED_STATUSES else "failed", result["detail"], updated, environment, result["family_id"])
+                         for result in results])
+        con.execute("COMMIT")
+    finally:
+        con.close()
+
+
+def submit_once(db_path, environment, run, rows, submit):
+    """
+    Calls submit with the rows the ledger doesn't know to be created or being created (see claim_cases), records
+    their results, and returns a result for every row in the order of rows.
+    """
+    send, known = claim_cases(db_path, environment, run, rows)
+    try:
+        results = submit([rows[i] for i in send]) if send else []
+    except Exception as e:
+        record_results(db_path, environment, [case_result(rows[i], detail=str(e)) for i in send])
+        raise
+    record_results(db_path, environment, results)
+    known.update(zip(send, results))
+    return [known[i] for i in range(len(rows))]
+
+
+def forget_cases(db_path, environment, family_ids):
+    """
+    Removes cases from the ledger, so they are sent again (e.g. after they were deleted in Emedgene).
+    """
+    con = connect(db_path)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        con.executemany("DELETE FROM uploads WHERE environment = ? AND family_id = ?", [(environment, family_id) for family_id in family_ids])
+        con.execute("COMMIT")
+    finally:
+        con.close()
+
+
+def create_parser():
+    parser = ArgumentParser(description="Show or edit the ledger of the cases the upload scripts sent to Emedgene.")
+    parser.add_argument("-d", "--db", type=str, default=None, help="The upload ledger (default: upload_ledger.sqlite in the local cache).")
+    parser.add_argument("-e", "--environment", type=str, default="prod", help="The environment (prod or test) of the cases (default: prod).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    show = subparsers.add_parser("show", help="Print the cases of the ledger as a tab separated table.")
+    show.add_argument("-r", "--run", type=str, default=None, help="Only the cases of this run folder.")
+    show.add_argument("--status", type=str, default=None, help="Only the cases with this status (submitting, created, unknown or failed).")
+
+    forget = subparsers.add_parser("forget", help="Remove cases from the ledger, so the next upload sends them again.")
+    forget.add_argument("family_ids", nargs="+", help="The Family Ids of the cases.")
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    db_path = args.db or default_ledger()
+    if args.command == "show":
+        query = "SELECT family_id, run, status, attempts, updated, detail FROM uploads WHERE environment = ?"
+        values = [args.environment]
+        if args.run is not None:
+            query += " AND run = ?"
+            values.append(args.run)
+        if args.status is not None:
+            query += " AND status = ?"
+            values.append(args.status)
+        con = connect(db_path)
+        print("family_id\trun\tstatus\tattempts\tupdated\tdetail")
+        for entry in con.execute(query + " ORDER BY updated, family_id", values):
+            print("\t".join("" if value is None else str(value) for value in entry))
+        con.close()
+    else:
+        forget_cases(db_path, args.environment, args.family_ids)
+        print("Removed %i cases from %s" % (len(args.family_ids), db_path))
@@ -0,0 +1,5 @@
+from os.path import abspath, dirname, join
+import sys
+
+# The scripts import their sibling modules directly, so the tests import them the same way
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "scripts"))
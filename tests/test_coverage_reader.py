@@ -0,0 +1,102 @@
+import gzip
+import tracemalloc
+from io import BytesIO
+from os.path import dirname, getsize, join
+import numpy as np
+from pandas import DataFrame, concat, read_csv
+from coverage_reader import (COVERAGE_COLUMNS, COVERAGE_DTYPES, BgzfReader, read_full_res_coverage, read_region_coverage,
+                             read_tabix_index, region_chunks, tabix_index_path)
+
+CHROMS = ["chr%s" % (c) for c in list(range(1, 23)) + ["X", "Y"]]
+# 8000 intervals of 10 bases on chr1 and 1500 on chr2, compressed with bgzip and indexed with tabix -p bed (htslib 1.x):
+# chr1 spans three BGZF blocks and five 16kb linear index windows
+TABIX_FIXTURE = join(dirname(__file__), "data", "S1.qc-coverage-region-1_full_res.bed.gz")
+BGZF_BLOCK_DATA = 0xff00  # bgzip fills every block with this many uncompressed bytes
+
+
+def writeFullRes(path, intervals_per_chrom):
+    rng = np.random.default_rng(5)
+    pieces = []
+    for chrom in CHROMS:
+        ends = np.cumsum(rng.integers(1, 40, intervals_per_chrom))
+        starts = np.concatenate(([0], ends[:-1]))
+        pieces.append(DataFrame({"chrom": chrom, "start": starts, "end": ends, "coverage": rng.integers(0, 300, intervals_per_chrom)}))
+    coverage = concat(pieces, ignore_index=True)
+    coverage.to_csv(path, sep="\t", header=False, index=False)
+    return coverage
+
+
+def tracedPeak(function):
+    tracemalloc.start()
+    try:
+        result = function()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_peak_memory_follows_kept_rows(tmp_path):
+    full_res = str(tmp_path / "S1.qc-coverage-region-1_full_res.bed")
+    coverage = writeFullRes(full_res, 20000)
+
+    (cov_index, rows_read), chunked_peak = tracedPeak(lambda: read_full_res_coverage(full_res, {"chr21"}, chunk_lines=5000))
+    whole_file, whole_file_peak = tracedPeak(lambda: read_csv(full_res, sep="\t", header=None, names=COVERAGE_COLUMNS, dtype=COVERAGE_DTYPES))
+
+    assert rows_read == coverage.shape[0] == whole_file.shape[0]
+    assert list(cov_index) == ["chr21"]
+    expected = coverage[coverage["chrom"] == "chr21"]
+    starts, ends, depths = cov_index["chr21"]
+    assert len(starts) == expected.shape[0] == 20000
+    np.testing.assert_array_equal(starts, expected["start"].to_numpy())
+    np.testing.assert_array_equal(ends, expected["end"].to_numpy())
+    np.testing.assert_array_equal(depths, expected["coverage"].to_numpy())
+    # One chromosome of 24 plus a 5000 line chunk, against the whole file at once
+    assert chunked_peak < whole_file_peak / 4, (chunked_peak, whole_file_peak)
+
+
+def fixtureCoverage():
+    with gzip.open(TABIX_FIXTURE, "rb") as fh:
+        text = fh.read()
+    return text, read_csv(BytesIO(text), sep="\t", header=None, names=COVERAGE_COLUMNS)
+
+
+def overlapping(coverage, chrom, beg, end):
+    rows = coverage[(coverage["chrom"] == chrom) & (coverage["start"] < end) & (coverage["end"] > beg)]
+    return rows.reset_index(drop=True)
+
+
+def test_tabix_index_and_bgzf_blocks():
+    text, coverage = fixtureCoverage()
+    index = read_tabix_index(tabix_index_path(TABIX_FIXTURE))
+    assert list(index) == ["chr1", "chr2"]
+    assert len(index["chr1"][1]) == 5
+
+    # Reading every block from the first virtual offset gives the whole file back
+    reader = BgzfReader(TABIX_FIXTURE)
+    try:
+        assert reader.read_range(0, getsize(TABIX_FIXTURE) << 16) == text
+    finally:
+        reader.close()
+
+    # The chunks of a region of the third window start in one block and end in another
+    chunks = region_chunks(index, "chr1", 40000, 41000)
+    assert chunks and all(chunk_beg >> 16 < chunk_end >> 16 for chunk_beg, chunk_end in chunks)
+    assert region_chunks(index, "chr3", 0, 1000) == []
+
+
+def test_region_coverage_across_block_boundaries():
+    text, coverage = fixtureCoverage()
+    # The interval whose line is split between the first two blocks, and every block boundary of chr1
+    boundaries = [int(coverage["start"][text[:offset].count(b"\n")]) for offset in range(BGZF_BLOCK_DATA, len(text), BGZF_BLOCK_DATA)]
+    regions = {"chr1": [(start - 15, start + 15) for start in boundaries] + [(79000, 80010)], "chr2": [(0, 25)], "chr3": [(0, 1000)]}
+
+    found = read_region_coverage(TABIX_FIXTURE, regions)
+    assert set(found["chrom"]) == {"chr1", "chr2"}
+    assert not found.duplicated(subset=["chrom", "start", "end"]).any()
+    for chrom, chrom_regions in regions.items():
+        for beg, end in chrom_regions:
+            expected = overlapping(coverage, chrom, beg, end)
+            assert overlapping(found, chrom, beg, end).equals(expected), (chrom, beg, end)
+            assert chrom == "chr3" or expected.shape[0] > 0
+
+    assert read_region_coverage(TABIX_FIXTURE, {"chr3": [(0, 1000)]}).shape[0] == 0
@@ -0,0 +1,66 @@
+from json import load
+import pytest
+from emg_auth import TOKEN_MARGIN, EmgToken, _token_cache_path, emg_login
+from emg_mock_server import MockEmedgene
+from emg_submit import submit_cases
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("ICA_EMG_CACHE_DIR", str(tmp_path))
+
+
+def cases(count):
+    return [{"Family Id": "NGS26-%04i_CGL1" % (i), "Case Type": "Exome"} for i in range(count)]
+
+
+def test_cached_token_is_reused():
+    with MockEmedgene(latency=0) as server:
+        token = emg_login(server.host, "user", "secret")
+        assert emg_login(server.host, "user", "secret") == token
+        assert server.logins == 1
+        assert emg_login(server.host, "user", "secret", use_cache=False) != token
+        assert server.logins == 2
+
+
+def test_token_close_to_expiring_is_replaced():
+    with MockEmedgene(latency=0, token_lifetime=TOKEN_MARGIN - 1) as server:
+        token = emg_login(server.host, "user", "secret")
+        assert emg_login(server.host, "user", "secret") != token
+        assert server.logins == 2
+
+
+def test_rejected_token_is_refreshed_once():
+    with MockEmedgene(latency=0) as server:
+        token = EmgToken(server.host, "user", "secret")
+        rejected = token.value
+        server.revoked.add(rejected)
+
+        results = submit_cases(cases(4), server.host, rejected, concurrency=4)
+        assert [result["http_status"] for result in results] == [401] * 4
+        assert server.cases == {}
+
+        results = submit_cases(cases(12), server.host, rejected, concurrency=4, refresh=token.refresh)
+        assert [result["status"] for result in results] == ["created"] * 12
+        assert server.logins == 2
+        assert token.value != rejected
+        assert set(server.cases.values()) == {1}
+        with open(_token_cache_path(server.host, "user")) as fh:
+            assert load(fh)["token"] == token.value
+        assert EmgToken(server.host, "user", "secret").value == token.value
+        assert server.logins == 2
+
+
+def test_verified_token_comes_from_a_login():
+    with MockEmedgene(latency=0) as server:
+        token = EmgToken(server.host, "user", "secret")
+        assert token.verified() == token.value
+        assert server.logins == 1
+
+        # A cached token may have been revoked: it is replaced by a login once
+        cached = EmgToken(server.host, "user", "secret")
+        assert server.logins == 1
+        verified = cached.verified()
+        assert verified != token.value and cached.verified() == verified
+        assert server.logins == 2
+        assert EmgToken(server.host, "user", "secret").value == verified
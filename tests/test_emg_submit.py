@@ -0,0 +1,55 @@
+from json import load
+from socket import socket
+import pytest
+from emg_mock_server import MockEmedgene
+from emg_submit import case_result, print_results, submit_cases, submit_chunks
+
+
+def cases(count):
+    return [{"Family Id": "NGS26-%04i_CGL1" % (i)} for i in range(count)]
+
+
+def test_resume_only_sends_failed_cases(tmp_path):
+    state_path = str(tmp_path / "RUN.emg_upload.state.json")
+    rows = cases(6)
+    outcomes = {"NGS26-0000_CGL1": "created", "NGS26-0001_CGL1": "unknown", "NGS26-0002_CGL1": "created",
+                "NGS26-0003_CGL1": "failed", "NGS26-0004_CGL1": "unknown", "NGS26-0005_CGL1": "unknown"}
+    sent = []
+
+    def submit_chunk(chunk_rows):
+        sent.extend(row["Family Id"] for row in chunk_rows)
+        return [case_result(row, outcomes[row["Family Id"]]) for row in chunk_rows]
+
+    results = submit_chunks(rows, submit_chunk, state_path, chunk_size=2, parallel_chunks=1)
+    assert [result["status"] for result in results] == list(outcomes.values())
+    with open(state_path) as fh:
+        assert [chunk["status"] for chunk in load(fh)["chunks"]] == ["unknown", "failed", "unknown"]
+    assert print_results(results) == 4
+
+    sent.clear()
+    outcomes["NGS26-0003_CGL1"] = "created"
+    results = submit_chunks(rows, submit_chunk, state_path, chunk_size=2, parallel_chunks=1, resume=True)
+    assert sent == ["NGS26-0003_CGL1"]
+    assert [result["status"] for result in results] == ["created", "unknown", "created", "created", "unknown", "unknown"]
+
+
+def test_unverified_request_is_only_sent_to_a_local_host():
+    with pytest.raises(ValueError):
+        submit_cases(cases(1), "https://pch-testing.emg.illumina.com", "Bearer token")
+
+
+def test_cases_the_server_may_have_created_are_unknown():
+    with MockEmedgene(latency=0, fail_rate=1.0) as server:
+        assert [result["status"] for result in submit_cases(cases(2), server.host, "Bearer token")] == ["unknown", "unknown"]
+        server.fail_rate = 0.0
+        server.latency = 1.0
+        assert submit_cases(cases(1), server.host, "Bearer token", timeout=0.2)[0]["status"] == "unknown"
+        server.latency = 0.0
+        server.revoked.add("Bearer token")
+        assert [(result["status"], result["http_status"]) for result in submit_cases(cases(1), server.host, "Bearer token")] == [("failed", 401)]
+
+    # Nothing listens on a port that was just released, so the case is never sent
+    with socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        host = "http://127.0.0.1:%i" % (sock.getsockname()[1])
+    assert [(result["status"], result["http_status"]) for result in submit_cases(cases(1), host, "Bearer token")] == [("failed", None)]
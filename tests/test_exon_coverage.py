@@ -0,0 +1,118 @@
+from bisect import bisect_left
+import numpy as np
+from pandas import DataFrame, Series, concat
+from CovReportConglomeration import buildCoverageIndex, coverageMetrics, exonCoverageStats, metricColumns
+
+METRIC_COLUMNS = metricColumns((0, 10, 20, 50, 100))
+
+
+# The per exon implementation exonCoverageStats replaced, as it was in CovReportConglomeration.py
+def exonCoverage(exon, coverage_data_sorted,covByCoverage):
+    start_index = bisect_left(coverage_data_sorted, (exon["chrom"], exon.start))
+
+    # Iterate forward and collect overlapping intervals
+    overlapping_intervals = []
+    for i in range(start_index-1, len(coverage_data_sorted)):
+        chrom, start, end, coverage = coverage_data_sorted[i]
+        if chrom != exon["chrom"] or start > exon.end: break # Use .chrom and .end
+        if end > exon.start: overlapping_intervals.append((start, end, coverage))
+
+    # Convert to DataFrame
+    exon_coverage = DataFrame(overlapping_intervals, columns=["start", "end", "coverage"])
+
+    #Get AVG coverage
+    exon_coverage["dif"] = exon_coverage["end"] - exon_coverage["start"]
+    totalBases = exon_coverage["dif"].sum()
+    exon_coverage["prod"] = exon_coverage["coverage"] * exon_coverage["dif"]
+    if exon["gene"] in covByCoverage: covByCoverage[exon["gene"]] = concat([covByCoverage[exon["gene"]],exon_coverage])
+    else: covByCoverage[exon["gene"]] = exon_coverage
+    if totalBases == 0:
+        return Series({
+        'AVG Coverage': 0,
+        '%Bases > 0X': 0.0,
+        '%Bases > 10X': 0.0,
+        '%Bases > 20X': 0.0,
+        '%Bases > 50X': 0.0,
+        '%Bases > 100X': 0.0
+    })
+
+    avgCov = exon_coverage["prod"].sum()/totalBases
+    percAbove_0x = exon_coverage[exon_coverage["coverage"]>0]["dif"].sum()/totalBases
+    percAbove_10x = exon_coverage[exon_coverage["coverage"]>=10]["dif"].sum()/totalBases
+    percAbove_20x = exon_coverage[exon_coverage["coverage"]>=20]["dif"].sum()/totalBases
+    percAbove_50x = exon_coverage[exon_coverage["coverage"]>=50]["dif"].sum()/totalBases
+    percAbove_100x = exon_coverage[exon_coverage["coverage"]>=100]["dif"].sum()/totalBases
+
+    if exon["gene"] in covByCoverage: covByCoverage[exon["gene"]] = concat([covByCoverage[exon["gene"]],exon_coverage])
+    else: covByCoverage[exon["gene"]] = exon_coverage
+
+    return Series({
+        'AVG Coverage': avgCov,
+        '%Bases > 0X': percAbove_0x,
+        '%Bases > 10X': percAbove_10x,
+        '%Bases > 20X': percAbove_20x,
+        '%Bases > 50X': percAbove_50x,
+        '%Bases > 100X': percAbove_100x
+    })
+
+
+def tiledCoverage(rng, chrom, first, intervals):
+    '''
+    Tiles a chromosome from first with intervals of 1 to 30 bases, the depths hitting every threshold exactly too.
+    '''
+    lengths = rng.integers(1, 31, intervals)
+    ends = first + np.cumsum(lengths)
+    depths = rng.choice([0, 1, 9, 10, 11, 19, 20, 21, 49, 50, 51, 99, 100, 101, 250], intervals)
+    return DataFrame({"chrom": chrom, "start": ends - lengths, "end": ends, "coverage": depths})
+
+
+def fixture():
+    '''
+    Returns a full resolution coverage DataFrame and a panel bed over it. chr1 is only covered from position 100 on,
+    chr2 from 0 and chrX not at all. Besides random exons the panel has exons before the first and after the last
+    interval of chr1, exons that end where an interval starts or start where one ends, and exons on chrX.
+    '''
+    rng = np.random.default_rng(7)
+    coverage = concat([tiledCoverage(rng, "chr1", 100, 400), tiledCoverage(rng, "chr2", 0, 400)], ignore_index=True)
+    exons = []
+    for chrom in ["chr1", "chr2"]:
+        chromCov = coverage[coverage["chrom"] == chrom]
+        low, high = int(chromCov["start"].min()) + 1, int(chromCov["end"].max())
+        for i in range(150):
+            start = int(rng.integers(low, high - 1))
+            exons.append((chrom, start, min(high + 20, start + int(rng.integers(0, 200)))))
+        starts, ends = chromCov["start"].to_numpy(), chromCov["end"].to_numpy()
+        exons += [(chrom, int(starts[50]) - 10, int(starts[60])), (chrom, int(ends[70]), int(ends[80])), (chrom, int(starts[90]), int(starts[90]))]
+    lastEnd = int(coverage[coverage["chrom"] == "chr1"]["end"].max())
+    exons += [("chr1", 0, 40), ("chr1", 10, 99), ("chr1", 50, 50), ("chr1", lastEnd, lastEnd + 100), ("chr1", lastEnd + 5, lastEnd + 50)]
+    exons += [("chrX", 0, 100), ("chrX", 5000, 5200)]
+    panelBed = DataFrame(exons, columns=["chrom", "start", "end"])
+    panelBed["exIDs"] = ["ex%i" % (i) for i in range(panelBed.shape[0])]
+    panelBed["gene"] = ["GENE%i" % (i // 6) for i in range(panelBed.shape[0])]
+    return coverage, panelBed.sample(frac=1, random_state=3).reset_index(drop=True)
+
+
+def test_exon_metrics_match_previous_implementation():
+    coverage, panelBed = fixture()
+    coverage_data_sorted = sorted(zip(coverage["chrom"], coverage["start"], coverage["end"], coverage["coverage"]))
+    expected = panelBed.apply(lambda exon: exonCoverage(exon, coverage_data_sorted, {}), axis=1)
+
+    stats = exonCoverageStats(panelBed, buildCoverageIndex(coverage))
+    actual = coverageMetrics(stats)
+    assert list(actual.columns) == METRIC_COLUMNS
+    np.testing.assert_allclose(actual[METRIC_COLUMNS].to_numpy(dtype=float), expected[METRIC_COLUMNS].to_numpy(dtype=float), rtol=1e-12, atol=0)
+    assert (stats.loc[panelBed["chrom"] == "chrX", "Bases"] == 0).all()
+    assert (stats.loc[(panelBed["chrom"] == "chr1") & (panelBed["end"] < 100), "Bases"] == 0).all()
+
+
+def test_exon_at_first_interval():
+    # The previous implementation started its scan at the interval before the bisect point, which for an exon starting
+    # at or before the first interval of a chromosome is on the previous chromosome, so it reported no coverage at all.
+    # exonCoverageStats counts the intervals that overlap the exon like it does for every other exon.
+    coverage = DataFrame({"chrom": ["chr1", "chr2", "chr2", "chr2"], "start": [0, 100, 110, 130],
+                          "end": [50, 110, 130, 160], "coverage": [30, 5, 20, 100]})
+    panelBed = DataFrame({"chrom": ["chr2", "chr2"], "start": [90, 100], "end": [115, 130],
+                          "exIDs": ["ex1", "ex2"], "gene": ["GENE1", "GENE1"]})
+    metrics = coverageMetrics(exonCoverageStats(panelBed, buildCoverageIndex(coverage)))
+    np.testing.assert_allclose(metrics.to_numpy(dtype=float), [[(10 * 5 + 20 * 20) / 30, 1.0, 20 / 30, 20 / 30, 0.0, 0.0],
+                                                               [(10 * 5 + 20 * 20 + 30 * 100) / 60, 1.0, 50 / 60, 50 / 60, 0.5, 0.5]])
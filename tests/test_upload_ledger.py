@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+from emg_submit import case_result, submit_chunks
+from upload_ledger import LEASE_MINUTES, connect, forget_cases, submit_once
+
+
+def case(sample, runFolder):
+    return {"Family Id": sample + "_CGL1", "Case Type": "Exome",
+            "Files Names": f"/{runFolder}/{sample}/{sample}.hard-filtered.vcf.gz", "BioSample Name": sample}
+
+
+class Uploader:
+    def __init__(self):
+        self.sent = []
+
+    def __call__(self, rows):
+        self.sent.extend(row["Family Id"] for row in rows)
+        return [case_result(row, "created") for row in rows]
+
+
+def test_created_cases_are_skipped_only_for_the_same_run_or_payload(tmp_path):
+    ledger = str(tmp_path / "upload_ledger.sqlite")
+    submit = Uploader()
+    rows = [case("NGS26-0001", "RUNA"), case("NGS26-0002", "RUNA")]
+    assert [result["status"] for result in submit_once(ledger, "test", "RUNA", rows, submit)] == ["created", "created"]
+    assert submit.sent == ["NGS26-0001_CGL1", "NGS26-0002_CGL1"]
+
+    # The same run again, and the same payload from another run folder name, are not sent
+    submit.sent.clear()
+    results = submit_once(ledger, "test", "RUNA", rows, submit) + submit_once(ledger, "test", "RUNA-retry", rows, submit)
+    assert submit.sent == []
+    assert [(result["status"], result["sent"]) for result in results] == [("created", False)] * 4
+
+    # A sample uploaded again from a new run folder has another payload: it fails without being sent
+    rerun = [case("NGS26-0001", "RUNB"), case("NGS26-0003", "RUNB")]
+    results = submit_once(ledger, "test", "RUNB", rerun, submit)
+    assert submit.sent == ["NGS26-0003_CGL1"]
+    assert [(result["status"], result["sent"]) for result in results] == [("failed", False), ("created", True)]
+    assert "upload_ledger.py -e test forget NGS26-0001_CGL1" in results[0]["detail"]
+
+    forget_cases(ledger, "test", ["NGS26-0001_CGL1"])
+    assert submit_once(ledger, "test", "RUNB", rerun[:1], submit)[0]["status"] == "created"
+    assert submit.sent == ["NGS26-0003_CGL1", "NGS26-0001_CGL1"]
+
+
+def test_chunk_log_counts_sent_cases(tmp_path, capsys):
+    ledger = str(tmp_path / "upload_ledger.sqlite")
+    rows = [case("NGS26-%04i" % (i), "RUNA") for i in range(4)]
+    submit = Uploader()
+    submit_once(ledger, "test", "RUNA", rows[:3], submit)
+    capsys.readouterr()
+
+    state_path = str(tmp_path / "RUNA.emg_upload.state.json")
+    submit_chunks(rows, lambda chunk_rows: submit_once(ledger, "test", "RUNA", chunk_rows, submit), state_path, chunk_size=2, parallel_chunks=1)
+    out = capsys.readouterr().out
+    assert "Chunk 1 of 2 done: sent 0 cases, 2 of 2 created" in out
+    assert "Chunk 2 of 2 done: sent 1 cases, 2 of 2 created" in out
+
+
+def test_stale_submitting_case_is_unknown(tmp_path):
+    ledger = str(tmp_path / "upload_ledger.sqlite")
+    rows = [case("NGS26-0001", "RUNA"), case("NGS26-0002", "RUNA")]
+
+    def dies(rows):
+        raise KeyboardInterrupt
+    try:
+        submit_once(ledger, "test", "RUNA", rows, dies)
+    except KeyboardInterrupt:
+        pass
+    submit = Uploader()
+    results = submit_once(ledger, "test", "RUNA", rows, submit)
+    assert submit.sent == []
+    assert [result["status"] for result in results] == ["failed", "failed"]
+    assert "Being submitted" in results[0]["detail"]
+
+    # The upload that died left the cases "submitting": after the lease they may have been created, so they aren't sent
+    stale = (datetime.now() - timedelta(minutes=LEASE_MINUTES + 1)).isoformat(timespec="seconds")
+    con = connect(ledger)
+    con.execute("UPDATE uploads SET updated = ?", (stale,))
+    con.close()
+    results = submit_once(ledger, "test", "RUNA", rows, submit)
+    assert submit.sent == []
+    assert [(result["status"], result["sent"]) for result in results] == [("unknown", False)] * 2
+    assert "upload_ledger.py -e test forget NGS26-0001_CGL1" in results[0]["detail"]
+    assert [result["status"] for result in submit_once(ledger, "test", "RUNA", rows, submit)] == ["unknown", "unknown"]
+
+    forget_cases(ledger, "test", ["NGS26-0001_CGL1"])
+    assert [result["status"] for result in submit_once(ledger, "test", "RUNA", rows, submit)] == ["created", "unknown"]
+    assert submit.sent == ["NGS26-0001_CGL1"]